@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+    Compare the per-call cost of the default and the hermetic execution
+    profiles.
+
+    Usage: python benchmarks/startup.py [repository] [calls]
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import hgapi  # noqa
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "."
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    profiles = [("default", hgapi.Repo.profile),
+                ("hermetic", hgapi.Repo.HERMETIC)]
+    for name, profile in profiles:
+        repo = hgapi.Repo(path, profile=profile)
+        repo.hg_id()  # warm up
+        seconds = timeit.timeit(repo.hg_id, number=calls)
+        print("%-10s %8.2f ms/call" % (name, 1000 * seconds / calls))
+
+
+if __name__ == "__main__":
+    main()
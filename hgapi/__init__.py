@@ -2,7 +2,36 @@
     Python API to Mercurial, without using the internal Mercurial API.
 """
 from . import hgapi as _hgapi
+from . import pool as _pool
+from . import mirror as _mirror
+from . import revset as _revset
+from . import columns as _columns
+from . import churn as _churn
+from . import bisection as _bisection
+from . import watch as _watch
+from . import backend as _backend
 Repo = _hgapi.Repo
 HgException = _hgapi.HgException
+HgLockException = _hgapi.HgLockException
+HgTimeoutException = _hgapi.HgTimeoutException
+HgCancelledException = _hgapi.HgCancelledException
+CancelToken = _hgapi.CancelToken
+deadline = _hgapi.deadline
+Profile = _hgapi.Profile
+Capabilities = _hgapi.Capabilities
+Scheduler = _hgapi.Scheduler
+Backend = _hgapi.Backend
+SubprocessBackend = _hgapi.SubprocessBackend
 hg_version = _hgapi.Repo.hg_version
 hg_clone = _hgapi.Repo.hg_clone
+WorkingCopyPool = _pool.WorkingCopyPool
+MirrorSync = _mirror.MirrorSync
+Query = _revset.Query
+HistoryColumns = _columns.HistoryColumns
+Churn = _churn.Churn
+ChurnStats = _churn.ChurnStats
+parallel_bisect = _bisection.parallel_bisect
+RepoWatcher = _watch.RepoWatcher
+CommandServerBackend = _backend.CommandServerBackend
+RecordingBackend = _backend.RecordingBackend
+ReplayBackend = _backend.ReplayBackend
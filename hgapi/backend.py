@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+    Backends running the hg commands of Repo objects: a pool of
+    persistent command servers, and backends recording outputs to fixture
+    files and replaying them without hg.
+"""
+from __future__ import print_function, unicode_literals, with_statement
+
+import base64
+import hashlib
+import json
+import os
+import struct
+import threading
+from subprocess import Popen, PIPE
+
+from .hgapi import (Repo, Backend, SubprocessBackend, HgException,
+                    HgLockException, HgTimeoutException,
+                    HgCancelledException, PRIORITY_NORMAL, _get_deadline)
+
+_ERRORS = dict((error.__name__, error) for error in (
+    HgException, HgLockException, HgTimeoutException, HgCancelledException))
+
+
+class _Server(object):
+    """A 'hg serve --cmdserver pipe' process."""
+
+    def __init__(self, executable, path, env):
+        env = dict(os.environ if env is None else env)
+        env["HGENCODING"] = "UTF-8"
+        cmd = [executable, "serve", "--cmdserver", "pipe", "--cwd", path,
+               "--config", "ui.interactive=False"]
+        try:
+            self.proc = Popen(cmd, stdin=PIPE, stdout=PIPE, env=env)
+        except OSError as ex:
+            raise HgException("Error running %s: %s" % (" ".join(cmd), ex))
+        channel, hello = self._read()
+        if channel != b"o" or b"runcommand" not in hello:
+            self.close()
+            raise HgException("%s is not a command server" % executable)
+
+    def _read(self):
+        header = self.proc.stdout.read(5)
+        if len(header) < 5:
+            raise HgException("The command server exited")
+        channel, length = header[:1], struct.unpack(str(">I"), header[1:])[0]
+        if channel in (b"I", b"L"):
+            return channel, length
+        return channel, self.proc.stdout.read(length)
+
+    def runcommand(self, args):
+        """
+            Start a command, then yield (channel, data) pairs of its
+            output and errors up to its exit code, on channel b"r".
+        """
+        data = b"\0".join(arg.encode("utf-8") for arg in args)
+        self.proc.stdin.write(b"runcommand\n" +
+                              struct.pack(str(">I"), len(data)) + data)
+        self.proc.stdin.flush()
+        while True:
+            channel, data = self._read()
+            if channel in (b"I", b"L"):
+                # no input: an empty answer makes prompts take defaults
+                self.proc.stdin.write(struct.pack(str(">I"), 0))
+                self.proc.stdin.flush()
+            elif channel == b"r":
+                yield channel, struct.unpack(str(">i"), data)[0]
+                return
+            elif channel in (b"o", b"e"):
+                yield channel, data
+            elif channel.isupper():
+                raise HgException("Unsupported command server channel %s"
+                                  % channel.decode("ascii"))
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc.stdout.close()
+        except (IOError, OSError):
+            pass
+
+
+class CommandServerBackend(Backend):
+    """
+        Run commands through persistent hg command servers, paying the
+        startup of Mercurial once per repository instead of once per
+        command.
+
+        Servers are started on first use for each path and environment
+        and kept until close(); concurrent commands on the same path get
+        servers of their own. Commands using stdin, stdout, chunk_size,
+        cancel or a timeout or deadline are run by fallback (a
+        SubprocessBackend by default) instead. The executable option of
+        commands is ignored.
+    """
+
+    def __init__(self, executable="hg", fallback=None):
+        self.executable = executable
+        self.fallback = fallback or SubprocessBackend()
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _delegated(self, kwargs):
+        for name in ("stdin", "stdout", "chunk_size", "cancel", "timeout"):
+            if kwargs.get(name) is not None:
+                return True
+        return _get_deadline() is not None
+
+    def _key(self, path, env):
+        path = os.path.abspath(path)
+        # a server started before the repository existed never finds it
+        exists = os.path.isdir(os.path.join(path, ".hg"))
+        env = None if env is None else tuple(sorted(env.items()))
+        return path, exists, env
+
+    def _acquire(self, key, path, env):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        return _Server(self.executable, path, env)
+
+    def _release(self, key, server):
+        with self._lock:
+            self._idle.setdefault(key, []).append(server)
+
+    def _run(self, path, env, args, kwargs, result):
+        """
+            Yield the output chunks of a command, setting the command
+            line, exit code and errors in result.
+        """
+        merge_stderr = kwargs.pop("merge_stderr", False)
+        priority = kwargs.pop("priority", PRIORITY_NORMAL)
+        kwargs.pop("executable", None)
+        for name in ("stdin", "stdout", "chunk_size", "cancel", "timeout"):
+            kwargs.pop(name, None)
+        if kwargs:
+            raise TypeError("Unexpected arguments: %s" % ", ".join(kwargs))
+        key = self._key(path, env)
+        errors = []
+        with Repo.scheduler.slot(path, priority):
+            server = self._acquire(key, path, env)
+            finished = False
+            try:
+                for channel, data in server.runcommand(list(args)):
+                    if channel == b"r":
+                        result["returncode"] = data
+                    elif channel == b"o" or merge_stderr:
+                        yield data
+                    else:
+                        errors.append(data)
+                finished = True
+            finally:
+                if finished:
+                    self._release(key, server)
+                else:
+                    # stopped in the middle of the output
+                    server.close()
+        result["cmd"] = [self.executable, "--cwd", path] + list(args)
+        result["err"] = b"".join(errors).decode("utf-8", "replace")
+
+    def run(self, path, env, *args, **kwargs):
+        if self._delegated(kwargs):
+            return self.fallback.run(path, env, *args, **kwargs)
+        result = {}
+        out = b"".join(self._run(path, env, args, kwargs, result))
+        out = out.decode("utf-8", "replace")
+        Repo._check_result(result["cmd"], result["returncode"], out,
+                           result["err"])
+        return out
+
+    def run_iter(self, path, env, *args, **kwargs):
+        if self._delegated(kwargs):
+            return self.fallback.run_iter(path, env, *args, **kwargs)
+        return self._lines(path, env, args, kwargs)
+
+    def _lines(self, path, env, args, kwargs):
+        result = {}
+        pending = b""
+        for chunk in self._run(path, env, args, kwargs, result):
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield (line + b"\n").decode("utf-8", "replace")
+        if pending:
+            yield pending.decode("utf-8", "replace")
+        Repo._check_result(result["cmd"], result["returncode"], "",
+                           result["err"])
+
+    def close(self):
+        """Stop all idle servers."""
+        with self._lock:
+            servers = [server for idle in self._idle.values()
+                       for server in idle]
+            self._idle.clear()
+        for server in servers:
+            server.close()
+        self.fallback.close()
+
+
+def _encode(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def _decode(data):
+    return base64.b64decode(data.encode("ascii"))
+
+
+class _Tee(object):
+    """A writable file object keeping a copy of what is written."""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.data = []
+
+    def write(self, data):
+        self.data.append(bytes(data))
+        return self.sink.write(data)
+
+    def flush(self):
+        self.sink.flush()
+
+    def close(self):
+        pass
+
+
+class _Fixtures(object):
+    """
+        Fixture files in directory, named after a hash of the path and
+        arguments of each command followed by the number of times the
+        same command was run before.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def next_name(self, path, args):
+        """Return the digest of a command and its number of runs."""
+        command = json.dumps([path, list(args)]).encode("utf-8")
+        digest = hashlib.sha1(command).hexdigest()[:20]
+        with self._lock:
+            count = self._counts.get(digest, 0)
+            self._counts[digest] = count + 1
+        return digest, count
+
+    def name(self, digest, count):
+        return os.path.join(self.directory, "%s-%d.json" % (digest, count))
+
+
+class RecordingBackend(Backend):
+    """
+        Run commands with backend (Repo.backend by default) and save each
+        output or error to a JSON file in directory, to be replayed by a
+        ReplayBackend. Output written to a stdout file object is saved
+        as well; stdin is not.
+    """
+
+    def __init__(self, directory, backend=None):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.backend = backend or Repo.backend
+        self._fixtures = _Fixtures(directory)
+
+    def _name(self, path, args):
+        return self._fixtures.name(*self._fixtures.next_name(path, args))
+
+    def _save(self, name, record):
+        with open(name, "wb") as fixture:
+            fixture.write(json.dumps(record, indent=1,
+                                     sort_keys=True).encode("utf-8"))
+
+    @staticmethod
+    def _error(ex):
+        return {"type": type(ex).__name__, "message": "%s" % ex,
+                "exit_code": ex.exit_code, "out": ex.out, "err": ex.err}
+
+    def run(self, path, env, *args, **kwargs):
+        name = self._name(path, args)
+        record = {"path": path, "args": list(args)}
+        sink = kwargs.get("stdout")
+        if sink is not None:
+            kwargs["stdout"] = tee = _Tee(sink)
+        try:
+            record["out"] = self.backend.run(path, env, *args, **kwargs)
+            return record["out"]
+        except HgException as ex:
+            record["error"] = self._error(ex)
+            raise
+        finally:
+            if sink is not None:
+                record["stdout"] = _encode(b"".join(tee.data))
+            self._save(name, record)
+
+    def run_iter(self, path, env, *args, **kwargs):
+        name = self._name(path, args)
+        chunked = bool(kwargs.get("chunk_size"))
+        output = []
+        record = {"path": path, "args": list(args),
+                  "chunks" if chunked else "lines": output}
+        try:
+            for item in self.backend.run_iter(path, env, *args, **kwargs):
+                output.append(_encode(item) if chunked else item)
+                yield item
+        except HgException as ex:
+            record["error"] = self._error(ex)
+            raise
+        finally:
+            self._save(name, record)
+
+    def close(self):
+        self.backend.close()
+
+
+class ReplayBackend(Backend):
+    """
+        Replay the outputs and errors saved by a RecordingBackend in
+        directory, without running hg.
+
+        Commands are matched on their path and arguments, and repeated
+        commands get their outputs in the order they were recorded; a
+        command run more often than recorded gets its last output again,
+        so a recording can be replayed in a loop to benchmark parsing.
+        Raise HgException for commands never recorded.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._fixtures = _Fixtures(directory)
+
+    def _load(self, path, args):
+        digest, count = self._fixtures.next_name(path, args)
+        name = self._fixtures.name(digest, count)
+        while count > 0 and not os.path.exists(name):
+            count -= 1
+            name = self._fixtures.name(digest, count)
+        try:
+            with open(name, "rb") as fixture:
+                return json.loads(fixture.read().decode("utf-8"))
+        except IOError:
+            raise HgException("No recording of hg %s in %s"
+                              % (" ".join(args), path))
+
+    @staticmethod
+    def _raise(record):
+        error = record.get("error")
+        if error is not None:
+            raise _ERRORS.get(error["type"], HgException)(
+                error["message"], exit_code=error["exit_code"],
+                out=error["out"], err=error["err"])
+
+    def run(self, path, env, *args, **kwargs):
+        record = self._load(path, args)
+        sink = kwargs.get("stdout")
+        if sink is not None and "stdout" in record:
+            sink.write(_decode(record["stdout"]))
+        self._raise(record)
+        return record["out"]
+
+    def run_iter(self, path, env, *args, **kwargs):
+        record = self._load(path, args)
+        if "chunks" in record:
+            for chunk in record["chunks"]:
+                yield _decode(chunk)
+        else:
+            for line in record.get("lines", ()):
+                yield line
+        self._raise(record)
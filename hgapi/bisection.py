@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+    Find the changeset that introduced a regression by testing several
+    revisions at a time, each in its own working copy.
+"""
+from __future__ import print_function, unicode_literals, with_statement
+
+import shutil
+import tempfile
+
+from .hgapi import Repo, _map_concurrently
+from .pool import WorkingCopyPool
+
+
+class BisectResult(object):
+    """
+        Outcome of a bisection.
+
+        first_bad is the full node of the first bad changeset, or None
+        when skipped changesets leave several candidates, all listed in
+        candidates. results maps the node of each changeset tested to
+        True (good), False (bad) or None (skipped).
+    """
+
+    def __init__(self, candidates, results):
+        self.candidates = candidates
+        self.results = results
+        self.first_bad = candidates[0] if len(candidates) == 1 else None
+
+    def __repr__(self):
+        if self.first_bad is not None:
+            state = "first bad %s" % self.first_bad[:12]
+        else:
+            state = "%d candidates" % len(self.candidates)
+        return "<BisectResult %s after %d tests>" % (state, len(self.results))
+
+
+def parallel_bisect(source, good, bad, test, probes=4, pool=None, root=None,
+                    profile=None):
+    """
+        Bisect the history of the repository at source between the good
+        revision (or list of revisions) and the bad one, returning a
+        BisectResult.
+
+        test is called with a Repo of a working copy updated to the
+        revision to test, and returns True if it is good, False if it is
+        bad, or None to skip it. Each round tests up to probes revisions
+        concurrently, splitting the remaining candidates in probes + 1
+        parts, so a regression among N changesets is found in about
+        log(N) / log(probes + 1) rounds.
+
+        The working copies are taken from pool, a WorkingCopyPool of
+        source; by default a pool of probes copies is created in root (a
+        temporary directory if None) and deleted afterwards.
+    """
+    repo = Repo(source, profile=profile)
+    goods = [good] if not isinstance(good, (list, tuple)) else list(good)
+    goods = [_node(repo, rev) for rev in goods]
+    bads = [_node(repo, bad)]
+    owned = pool is None
+    if owned:
+        temporary = root is None
+        root = tempfile.mkdtemp(prefix="hgapi-bisect-") if temporary \
+            else root
+        pool = WorkingCopyPool(source, root, max_copies=probes,
+                               profile=profile)
+    results = {}
+
+    def run(node):
+        with pool.checkout(node) as copy:
+            outcome = test(copy)
+        return None if outcome is None else bool(outcome)
+
+    try:
+        while True:
+            candidates = _candidates(repo, goods, bads)
+            untested = [node for node in candidates if node not in results]
+            if len(candidates) <= 1 or not untested:
+                return BisectResult(candidates, results)
+            count = min(probes, len(untested))
+            picks = [untested[index] for index in sorted(set(
+                i * len(untested) // (count + 1)
+                for i in range(1, count + 1)))]
+            outcomes = _map_concurrently(run, picks, count)
+            for node, outcome in zip(picks, outcomes):
+                results[node] = outcome
+                if outcome is True:
+                    goods.append(node)
+                elif outcome is False:
+                    bads.append(node)
+    finally:
+        if owned:
+            pool.close()
+            if temporary:
+                shutil.rmtree(root, ignore_errors=True)
+
+
+def _node(repo, revision):
+    return repo.hg_log(identifier=str(revision), template="{node}").strip()
+
+
+def _candidates(repo, goods, bads):
+    """
+        Return the nodes, in revision order, of the changesets that are
+        ancestors of all bad changesets but of no good one.
+    """
+    revset = "(%s) - ::(%s)" % (" and ".join("::%s" % node for node in bads),
+                                "+".join(goods))
+    return repo.hg_log(identifier="sort(%s, rev)" % revset,
+                       template="{node}\\n").split()
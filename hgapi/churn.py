@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+    Change statistics (churn) per file and per author, gathered from a
+    single streamed 'hg log --patch'.
+"""
+from __future__ import print_function, unicode_literals, with_statement
+
+_RECORD = "\x1e"
+_SEPARATOR = "\x1f"
+
+
+class ChurnStats(object):
+    """Number of changesets and of lines added and removed."""
+
+    __slots__ = ("changesets", "added", "removed")
+
+    def __init__(self, changesets=0, added=0, removed=0):
+        self.changesets = changesets
+        self.added = added
+        self.removed = removed
+
+    def __eq__(self, other):
+        return (self.changesets, self.added, self.removed) == \
+            (other.changesets, other.added, other.removed)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "ChurnStats(changesets=%d, added=%d, removed=%d)" % (
+            self.changesets, self.added, self.removed)
+
+
+def _diff_path(line):
+    """Return the path of a 'diff --git a/path b/path' line."""
+    paths = line[len("diff --git a/"):]
+    half = (len(paths) - len(" b/")) // 2
+    if paths[:half] == paths[half + len(" b/"):]:
+        return paths[:half]
+    # a copy or rename, the following "rename to" line holds the path
+    return paths.rsplit(" b/", 1)[-1]
+
+
+class Churn(object):
+    """
+        Aggregated changes of a set of changesets.
+
+        files maps each path to the ChurnStats of the changesets touching
+        it, authors each author to the ChurnStats of their changesets.
+        Memory use grows with the number of distinct files and authors,
+        not with the length of the history. Merges are counted against
+        their first parent, binary files count as changed without lines.
+    """
+
+    def __init__(self):
+        self.changesets = 0
+        self.files = {}
+        self.authors = {}
+
+    @classmethod
+    def from_repo(cls, repo, revset="all()", include=(), exclude=(),
+                  shards=1, **kwargs):
+        """
+            Gather the churn of the changesets of repo matching revset
+            (a string or a hgapi.Query), restricted to the files matching
+            the include and exclude patterns (hg -I and -X patterns, such
+            as 'glob:**.py'). With shards other than 1, the history is
+            read from that many concurrent hg processes (see
+            Repo.map_shards). Keyword arguments are passed on to
+            Repo.hg_command_iter.
+        """
+        churn = cls()
+        if shards != 1:
+            for shard in repo.map_shards(
+                    lambda revset: cls.from_repo(repo, revset, include,
+                                                 exclude, **kwargs),
+                    revset, shards):
+                churn.update(shard)
+            return churn
+        args = ["log", "--patch", "--git", "-r", str(revset), "--template",
+                "\\x1e{rev}\\x1f{author}\\n"]
+        for pattern in include:
+            args += ["-I", pattern]
+        for pattern in exclude:
+            args += ["-X", pattern]
+        churn.read(repo.hg_command_iter(*args, **kwargs))
+        return churn
+
+    def read(self, lines):
+        """Aggregate the changesets of a log output, one line at a time."""
+        author, files, path, header = None, {}, None, False
+        for line in lines:
+            if line.startswith(_RECORD):
+                if author is not None:
+                    self.add(author, files)
+                author = line.rstrip("\n").split(_SEPARATOR, 1)[1]
+                files, path = {}, None
+            elif line.startswith("diff --git a/"):
+                path = _diff_path(line.rstrip("\n"))
+                files.setdefault(path, [0, 0])
+                header = True
+            elif path is None:
+                continue
+            elif header:
+                if line.startswith("@@"):
+                    header = False
+                elif line.startswith(("rename to ", "copy to ")):
+                    del files[path]
+                    path = line.rstrip("\n").split(" to ", 1)[1]
+                    files.setdefault(path, [0, 0])
+            elif line.startswith("+"):
+                files[path][0] += 1
+            elif line.startswith("-"):
+                files[path][1] += 1
+        if author is not None:
+            self.add(author, files)
+
+    def add(self, author, files):
+        """
+            Count a changeset by author, files mapping the paths changed
+            to a pair of the numbers of lines added and removed.
+        """
+        self.changesets += 1
+        stats = self.authors.setdefault(author, ChurnStats())
+        stats.changesets += 1
+        for path, (added, removed) in files.items():
+            stats.added += added
+            stats.removed += removed
+            file_stats = self.files.setdefault(path, ChurnStats())
+            file_stats.changesets += 1
+            file_stats.added += added
+            file_stats.removed += removed
+
+    def update(self, other):
+        """Add the counts of another Churn, of distinct changesets."""
+        self.changesets += other.changesets
+        for mine, theirs in ((self.files, other.files),
+                             (self.authors, other.authors)):
+            for key, stats in theirs.items():
+                total = mine.setdefault(key, ChurnStats())
+                total.changesets += stats.changesets
+                total.added += stats.added
+                total.removed += stats.removed
+
+    def hotspots(self, count=10, key="changesets"):
+        """
+            Return the count (path, ChurnStats) pairs of the files with the
+            most changes, key being "changesets", "added", "removed" or
+            "lines" (added and removed).
+        """
+        def order(item):
+            path, stats = item
+            if key == "lines":
+                return -(stats.added + stats.removed), path
+            return -getattr(stats, key), path
+        return sorted(self.files.items(), key=order)[:count]
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+    Export of history as columns of compact arrays, for vectorized
+    analysis with NumPy, pandas or Arrow.
+"""
+from __future__ import print_function, unicode_literals, with_statement
+
+import array
+import binascii
+
+_SEPARATOR = "\x1f"
+
+_TEMPLATE = "\\x1f".join(["{rev}", "{node}", "{date|hgdate}", "{p1rev}",
+                          "{p2rev}", "{branch}", "{author}"])
+
+
+def _ints():
+    return array.array(str("l"))
+
+
+class HistoryColumns(object):
+    """
+        The changesets of a revset as columns, one entry per changeset in
+        revset order.
+
+        rev, p1 and p2 (the parent revisions, -1 for none), timestamp
+        (seconds since the epoch) and tzoffset (seconds west of UTC) are
+        arrays of numbers. node is a bytearray of the 20 bytes binary
+        nodes. author and branch are arrays of indexes in the authors and
+        branch_names lists of distinct values. files, when exported, is an
+        array of the number of files changed by each changeset.
+
+        to_numpy() and to_arrow() convert the columns when NumPy or
+        pyarrow are installed; the numeric arrays are shared with NumPy
+        rather than copied.
+    """
+
+    COLUMNS = ("rev", "node", "author", "branch", "timestamp", "tzoffset",
+               "p1", "p2", "files")
+
+    def __init__(self, files=False):
+        self.rev = _ints()
+        self.node = bytearray()
+        self.author = _ints()
+        self.authors = []
+        self.branch = _ints()
+        self.branch_names = []
+        self.timestamp = array.array(str("d"))
+        self.tzoffset = _ints()
+        self.p1 = _ints()
+        self.p2 = _ints()
+        self.files = _ints() if files else None
+        self._author_codes = {}
+        self._branch_codes = {}
+
+    @classmethod
+    def from_repo(cls, repo, revset="all()", files=False, shards=1,
+                  **kwargs):
+        """
+            Export the changesets of repo matching revset (a string or a
+            hgapi.Query), reading the log as it is streamed from a single
+            hg process. With files set, the number of files changed by
+            each changeset is exported too. With shards other than 1, the
+            log is read from that many concurrent hg processes (see
+            Repo.map_shards) and the shards concatenated in revision
+            order. Keyword arguments are passed on to
+            Repo.hg_command_iter.
+        """
+        columns = cls(files)
+        if shards != 1:
+            for shard in repo.map_shards(
+                    lambda revset: cls.from_repo(repo, revset, files,
+                                                 **kwargs),
+                    revset, shards):
+                columns.extend(shard)
+            return columns
+        template = _TEMPLATE
+        if files:
+            template = "{files|count}\\x1f" + template
+        for line in repo.hg_command_iter("log", "-r", str(revset),
+                                         "--template", template + "\\n",
+                                         **kwargs):
+            columns.append(line.rstrip("\n"))
+        return columns
+
+    @staticmethod
+    def _code(codes, values, value):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    def append(self, line):
+        """Add a changeset from a line of the export template."""
+        fields = line.split(_SEPARATOR, 7 if self.files is not None else 6)
+        if self.files is not None:
+            self.files.append(int(fields.pop(0)))
+        rev, node, date, p1, p2, branch, author = fields
+        timestamp, tzoffset = date.split()
+        self.rev.append(int(rev))
+        self.node.extend(binascii.unhexlify(node))
+        self.timestamp.append(float(timestamp))
+        self.tzoffset.append(int(tzoffset))
+        self.p1.append(int(p1))
+        self.p2.append(int(p2))
+        self.branch.append(self._code(self._branch_codes, self.branch_names,
+                                      branch))
+        self.author.append(self._code(self._author_codes, self.authors,
+                                      author))
+
+    def extend(self, other):
+        """Append the changesets of another HistoryColumns."""
+        for name in ("rev", "node", "timestamp", "tzoffset", "p1", "p2"):
+            getattr(self, name).extend(getattr(other, name))
+        if self.files is not None:
+            self.files.extend(other.files)
+        for column, codes, values, theirs, their_values in (
+                (self.author, self._author_codes, self.authors,
+                 other.author, other.authors),
+                (self.branch, self._branch_codes, self.branch_names,
+                 other.branch, other.branch_names)):
+            mapping = [self._code(codes, values, value)
+                       for value in their_values]
+            column.extend(mapping[code] for code in theirs)
+
+    def __len__(self):
+        return len(self.rev)
+
+    def hex(self, index):
+        """Return the full hex node of the changeset at index."""
+        return binascii.hexlify(
+            bytes(self.node[index * 20:(index + 1) * 20])).decode("ascii")
+
+    def to_numpy(self):
+        """
+            Return a dict of NumPy arrays by column name. node is an array
+            of 20 bytes strings, author and branch arrays of strings.
+        """
+        import numpy
+        result = {"node": numpy.frombuffer(bytes(self.node), dtype="S20")}
+        for name in ("rev", "timestamp", "tzoffset", "p1", "p2", "files"):
+            column = getattr(self, name)
+            if column is not None:
+                result[name] = numpy.frombuffer(column, dtype=column.typecode)
+        for name, values in (("author", self.authors),
+                             ("branch", self.branch_names)):
+            codes = getattr(self, name)
+            codes = numpy.frombuffer(codes, dtype=codes.typecode)
+            result[name] = numpy.array(values, dtype=object)[codes]
+        return result
+
+    def to_arrow(self):
+        """
+            Return a pyarrow Table of the columns, author and branch being
+            dictionary encoded. Needs NumPy as well.
+        """
+        import numpy
+        import pyarrow
+        arrays, names = [], []
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            if column is None:
+                continue
+            if name == "node":
+                column = pyarrow.FixedSizeBinaryArray.from_buffers(
+                    pyarrow.binary(20), len(self),
+                    [None, pyarrow.py_buffer(bytes(self.node))])
+            elif name in ("author", "branch"):
+                values = self.authors if name == "author" \
+                    else self.branch_names
+                column = pyarrow.DictionaryArray.from_arrays(
+                    numpy.frombuffer(column, dtype=column.typecode), values)
+            else:
+                column = pyarrow.array(
+                    numpy.frombuffer(column, dtype=column.typecode))
+            arrays.append(column)
+            names.append(name)
+        return pyarrow.Table.from_arrays(arrays, names=names)
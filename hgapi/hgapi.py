@@ -1,31 +1,759 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, unicode_literals, with_statement
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, STDOUT
 
 try:
     from urllib import unquote
 except ImportError:  # python 3
     from urllib.parse import unquote
 
+import io
+import collections
 import re
 import os
 import sys
+import time
+import signal
+import shutil
+import struct
+import tempfile
+import itertools
+import multiprocessing
+import threading
+import zlib
+from contextlib import contextmanager
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+try:
+    from collections.abc import Sequence
+except ImportError:  # python 2
+    from collections import Sequence
 
 try:
     import json  # for reading logs
 except ImportError:
     import simplejson as json
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 
 class HgException(Exception):
     """
         Exception class allowing a exit_code parameter and member
         to be used when calling Mercurial to return exit code.
+
+        out and err hold the output of the failed command, if any.
     """
 
-    def __init__(self, msg, exit_code=None):
+    def __init__(self, msg, exit_code=None, out=None, err=None):
         super(HgException, self).__init__(msg)
         self.exit_code = exit_code
+        self.out = out
+        self.err = err
+
+
+class HgLockException(HgException):
+    """Raised when hg gives up waiting for a repository lock."""
+
+
+class HgTimeoutException(HgException):
+    """Raised when a command does not finish before its deadline."""
+
+
+class HgCancelledException(HgException):
+    """Raised when a command is cancelled through a CancelToken."""
+
+
+_deadlines = threading.local()
+
+_write_locks = {}
+_write_locks_lock = threading.Lock()
+
+
+def _write_lock(path):
+    """Return the in-process writer lock for the repository at path."""
+    path = os.path.realpath(path)
+    with _write_locks_lock:
+        return _write_locks.setdefault(path, threading.RLock())
+
+
+@contextmanager
+def deadline(seconds):
+    """
+        Apply a deadline to every hg command the current thread runs
+        inside the with block::
+
+          >>> with hgapi.deadline(30):
+          ...     repo.hg_pull()
+
+        A nested deadline can shorten, but never extend, an outer one.
+    """
+    outer = getattr(_deadlines, "value", None)
+    value = time.time() + seconds
+    if outer is not None:
+        value = min(value, outer)
+    _deadlines.value = value
+    try:
+        yield
+    finally:
+        _deadlines.value = outer
+
+
+def _get_deadline(timeout=None):
+    """Return the absolute deadline for a command, or None."""
+    value = getattr(_deadlines, "value", None)
+    if timeout is not None:
+        value = min(value or float("inf"), time.time() + timeout)
+    return value
+
+
+def _kill(proc, grace=2.0):
+    """
+        Terminate proc, and its children when it leads a process group.
+        Kill it if it is still running after grace seconds.
+    """
+    group = getattr(proc, "hgapi_group", False)
+
+    def send(sig):
+        if proc.poll() is not None:
+            return
+        try:
+            if group and os.name == "posix":
+                os.killpg(proc.pid, sig)
+            elif group and sys.platform == "win32":
+                Popen(["taskkill", "/F", "/T", "/PID", str(proc.pid)],
+                      stdout=PIPE, stderr=PIPE).communicate()
+            elif sig == signal.SIGTERM:
+                proc.terminate()
+            else:
+                proc.kill()
+        except OSError:
+            pass
+
+    send(signal.SIGTERM)
+    timer = threading.Timer(grace, send,
+                            (getattr(signal, "SIGKILL", signal.SIGTERM),))
+    timer.daemon = True
+    timer.start()
+
+
+class CancelToken(object):
+    """
+        Cooperative cancellation of running commands.
+
+        Pass the token as the cancel keyword argument of a command;
+        calling cancel() terminates every process started with it, and
+        makes the command raise HgCancelledException.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._procs = set()
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancel all current and future commands using this token."""
+        with self._lock:
+            self.cancelled = True
+            procs = list(self._procs)
+        for proc in procs:
+            _kill(proc)
+
+    def _register(self, proc):
+        with self._lock:
+            if not self.cancelled:
+                self._procs.add(proc)
+                return
+        _kill(proc)
+
+    def _unregister(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+
+
+class _Watchdog(object):
+    """Enforce deadline and cancellation for a running process."""
+
+    def __init__(self, proc, deadline, cancel):
+        self.proc = proc
+        self.cancel = cancel
+        self.expired = False
+        self._timer = None
+        if deadline is not None:
+            self._timer = threading.Timer(max(0, deadline - time.time()),
+                                          self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        if cancel is not None:
+            cancel._register(proc)
+
+    def _expire(self):
+        self.expired = True
+        _kill(self.proc)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.cancel is not None:
+            self.cancel._unregister(self.proc)
+
+    def check(self, cmd):
+        """Raise if the process was stopped by the deadline or cancel."""
+        if self.expired:
+            raise HgTimeoutException("Timeout running %s" % " ".join(cmd))
+        if self.cancel is not None and self.cancel.cancelled:
+            raise HgCancelledException("Cancelled %s" % " ".join(cmd))
+
+
+_probed_executables = {}
+_detected_executable = []
+_probe_lock = threading.Lock()
+_capabilities = {}
+_capabilities_lock = threading.Lock()
+
+
+def _which(name):
+    """Return the full path of executable name on PATH, or None."""
+    extensions = [""]
+    if sys.platform == "win32":
+        extensions += os.environ.get("PATHEXT", ".EXE").split(os.pathsep)
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        for ext in extensions:
+            candidate = os.path.join(directory, name + ext)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return candidate
+    return None
+
+
+def _save_json(path, value):
+    """Write value to the JSON file at path, replacing it atomically."""
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as target:
+            target.write(json.dumps(value, sort_keys=True).encode("utf-8"))
+        if os.name != "posix" and os.path.exists(path):
+            os.remove(path)
+        os.rename(temporary, path)
+    except (IOError, OSError):
+        pass  # the cache is an optimization, a read-only home is fine
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+
+def _stdin_source(stdin):
+    """
+        Return (stdin argument for Popen, bytes to send, file object to
+        feed from a thread) for the stdin option of Repo.command.
+    """
+    if stdin is None:
+        return None, None, None
+    if isinstance(stdin, bytes):
+        return PIPE, stdin, None
+    if not _has_fileno(stdin):
+        return PIPE, None, stdin
+    return stdin, None, None
+
+
+def _has_fileno(fileobj):
+    try:
+        fileobj.fileno()
+    except (AttributeError, IOError, ValueError, io.UnsupportedOperation):
+        return False
+    return True
+
+
+def _tell(fileobj):
+    """Return the position of a seekable file object, or None."""
+    try:
+        if hasattr(fileobj, "seekable") and not fileobj.seekable():
+            return None
+        return fileobj.tell()
+    except (AttributeError, IOError, OSError, ValueError,
+            io.UnsupportedOperation):
+        return None
+
+
+def _feed(source, pipe, chunk_size=65536, close=True):
+    """Copy the file object source to pipe in a new thread."""
+    def copy():
+        try:
+            for chunk in iter(lambda: source.read(chunk_size), b""):
+                pipe.write(chunk)
+        except (IOError, OSError):
+            pass  # the process exited or was terminated
+        finally:
+            try:
+                (pipe if close else source).close()
+            except (IOError, OSError):
+                pass
+    thread = threading.Thread(target=copy)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _max_arg_length():
+    """Return a safe total length for the arguments of a command line."""
+    if sys.platform == "win32":
+        return 30000
+    try:
+        limit = os.sysconf(str("SC_ARG_MAX"))
+    except (AttributeError, ValueError, OSError):
+        limit = 131072
+    if limit <= 0:
+        limit = 131072
+    environment = sum(len(k) + len(v) + 2 for k, v in os.environ.items())
+    # leave room for the environment and pointers, and don't go overboard
+    return max(min(limit - environment - 4096, 1 << 20) // 2, 4096)
+
+
+def _arg_chunks(args, fixed, limit=None):
+    """
+        Split args into lists that fit on a command line together with
+        the fixed arguments, yielding each list.
+    """
+    limit = limit or _max_arg_length()
+    base = sum(len(arg.encode("utf-8")) + 9 for arg in fixed)
+    chunk, size = [], base
+    for arg in args:
+        cost = len(arg.encode("utf-8")) + 9
+        if chunk and size + cost > limit:
+            yield chunk
+            chunk, size = [], base
+        chunk.append(arg)
+        size += cost
+    if chunk:
+        yield chunk
+
+
+def _map_concurrently(func, items, concurrency):
+    """
+        Return [func(item) for item in items], calling func from at most
+        concurrency threads at a time.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = iter(range(len(items)))
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                index = next(pending, None)
+            if index is None or errors:
+                return
+            try:
+                results[index] = func(items[index])
+            except BaseException:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max(concurrency, 1), len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][1]
+    return results
+
+
+class _IterStream(io.RawIOBase):
+    """Readable binary stream over an iterator of bytes chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self._buffer:
+            self._buffer = next(self._chunks, None)
+            if self._buffer is None:
+                self._buffer = b""
+                return 0
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._chunks.close()
+        super(_IterStream, self).close()
+
+
+class _LRUCache(object):
+    """A thread-safe mapping keeping the maxsize most recently used keys."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+#: A line of hg annotate output: the revision number, full node, author,
+#: (timestamp, offset) date, line number and path where the line was
+#: introduced, and the line itself.
+AnnotatedLine = collections.namedtuple(
+    "AnnotatedLine", "rev node author date line_number path line")
+
+_B85_ALPHABET = ("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+                 "abcdefghijklmnopqrstuvwxyz!#$%&()*+-;<=>?@^_`{|}~")
+
+
+def _b85encode(data):
+    """Encode bytes with the base85 alphabet of git binary patches."""
+    data += b"\0" * (-len(data) % 4)
+    encoded = []
+    for offset in range(0, len(data), 4):
+        word = struct.unpack(str(">I"), data[offset:offset + 4])[0]
+        chars = []
+        for _ in range(5):
+            word, digit = divmod(word, 85)
+            chars.append(_B85_ALPHABET[digit])
+        encoded.extend(reversed(chars))
+    return "".join(encoded)
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode("utf-8")
+
+
+def _changeset_patch(files, message, user=None, date=None, tracked=None):
+    """
+        Build a patch in hg export format for one changeset.
+
+        files maps paths to their new content (bytes, or text encoded as
+        UTF-8), or to None to remove the file. Contents are written as git
+        binary literals, which replace the whole file, so the patch does
+        not depend on the previous contents. tracked is the set of paths
+        present before the change, updated to the paths present after it.
+
+        Raise ValueError when files is empty or removes a path that is
+        not tracked, either of which would make hg import skip the
+        changeset or fail.
+    """
+    tracked = set() if tracked is None else tracked
+    if not files:
+        raise ValueError("A change must modify at least one file")
+    for path in files:
+        if files[path] is None and path not in tracked:
+            raise ValueError("Cannot remove %s, it is not tracked" % path)
+    lines = ["# HG changeset patch"]
+    if user:
+        lines.append("# User %s" % user)
+    if date:
+        lines.append("# Date %s" % date)
+    lines.append(message.rstrip("\n"))
+    lines.append("")
+    for path in sorted(files):
+        content = files[path]
+        lines.append("diff --git a/%s b/%s" % (path, path))
+        if content is None:
+            lines.append("deleted file mode 100644")
+            tracked.discard(path)
+            continue
+        if path not in tracked:
+            lines.append("new file mode 100644")
+            tracked.add(path)
+        content = _to_bytes(content)
+        compressed = zlib.compress(content)
+        lines.append("GIT binary patch")
+        lines.append("literal %d" % len(content))
+        for offset in range(0, len(compressed), 52):
+            chunk = compressed[offset:offset + 52]
+            size = len(chunk)
+            prefix = chr(ord("A") + size - 1) if size <= 26 \
+                else chr(ord("a") + size - 27)
+            lines.append(prefix + _b85encode(chunk))
+        lines.append("")
+    return _to_bytes("\n".join(lines) + "\n")
+
+
+class Scheduler(object):
+    """
+        Process-wide admission control for hg subprocesses.
+
+        At most max_processes commands run at once, and at most
+        max_per_path for any single repository path; None means no limit.
+        Waiting commands are admitted in priority order (lower value
+        first, see the PRIORITY_* constants), then in arrival order.
+
+        Queue time is recorded per priority and available from metrics().
+    """
+
+    def __init__(self, max_processes=None, max_per_path=None):
+        self.max_processes = max_processes
+        self.max_per_path = max_per_path
+        self._cond = threading.Condition()
+        self._running = 0
+        self._per_path = {}
+        self._waiting = []
+        self._counter = itertools.count()
+        self._stats = {}
+
+    def configure(self, max_processes=None, max_per_path=None):
+        """Change the concurrency limits, waking up waiting commands."""
+        with self._cond:
+            self.max_processes = max_processes
+            self.max_per_path = max_per_path
+            self._cond.notify_all()
+
+    def _admissible(self, path):
+        if (self.max_processes is not None and
+                self._running >= self.max_processes):
+            return False
+        return (self.max_per_path is None or
+                self._per_path.get(path, 0) < self.max_per_path)
+
+    def acquire(self, path, priority=PRIORITY_NORMAL, deadline=None):
+        """
+            Block until a command may run in path.
+
+            Raise HgTimeoutException if deadline (as returned by
+            time.time()) passes first.
+        """
+        path = os.path.abspath(path)
+        entry = (priority, next(self._counter), path)
+        start = time.time()
+        with self._cond:
+            self._waiting.append(entry)
+            try:
+                while True:
+                    ready = [e for e in self._waiting
+                             if self._admissible(e[2])]
+                    if ready and min(ready) == entry:
+                        break
+                    if deadline is None:
+                        self._cond.wait()
+                    elif deadline > time.time():
+                        self._cond.wait(deadline - time.time())
+                    else:
+                        raise HgTimeoutException(
+                            "Timeout waiting to run a command in %s" % path)
+            finally:
+                self._waiting.remove(entry)
+                self._cond.notify_all()
+            self._running += 1
+            self._per_path[path] = self._per_path.get(path, 0) + 1
+            waited = time.time() - start
+            stats = self._stats.setdefault(
+                priority, {"count": 0, "total": 0.0, "max": 0.0})
+            stats["count"] += 1
+            stats["total"] += waited
+            stats["max"] = max(stats["max"], waited)
+
+    def release(self, path):
+        """Mark a command in path as finished."""
+        path = os.path.abspath(path)
+        with self._cond:
+            self._running -= 1
+            self._per_path[path] -= 1
+            if not self._per_path[path]:
+                del self._per_path[path]
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, path, priority=PRIORITY_NORMAL, deadline=None):
+        """Context manager holding a process slot for path."""
+        self.acquire(path, priority, deadline)
+        try:
+            yield
+        finally:
+            self.release(path)
+
+    def metrics(self):
+        """
+            Return a dict with the number of 'running' and 'waiting'
+            commands and, under 'queue_time', a priority -> stats mapping
+            where stats has 'count', 'total' and 'max' seconds waited.
+        """
+        with self._cond:
+            return {"running": self._running,
+                    "waiting": len(self._waiting),
+                    "queue_time": dict((k, dict(v))
+                                       for k, v in self._stats.items())}
+
+    def reset_metrics(self):
+        """Clear the recorded queue times."""
+        with self._cond:
+            self._stats = {}
+
+
+class Profile(object):
+    """
+        Execution profile for hg subprocesses: the environment and the
+        global options passed to every call.
+
+        plain sets HGPLAIN, disabling output localization and any user
+        settings that change output formats.
+
+        hgrcpath sets HGRCPATH. An empty string makes hg skip the global
+        and user configuration files (the repository hgrc is still read),
+        so extensions and hooks enabled there are not loaded. None leaves
+        HGRCPATH as found in the environment.
+
+        extensions is a list of extension names to enable, and config a
+        dict of 'section.name': value settings, both passed as --config.
+    """
+
+    def __init__(self, plain=True, hgrcpath="", extensions=None,
+                 config=None, env=None):
+        self.plain = plain
+        self.hgrcpath = hgrcpath
+        self.extensions = list(extensions or [])
+        self.config = dict(config or {})
+        self.env = dict(os.environ if env is None else env)
+        self.env[str('LANG')] = str('en_US')
+        if plain:
+            self.env[str('HGPLAIN')] = str('1')
+        if hgrcpath is not None:
+            self.env[str('HGRCPATH')] = str(hgrcpath)
+
+    @property
+    def args(self):
+        """Global options to pass to hg."""
+        args = []
+        for ext in self.extensions:
+            args += ["--config", "extensions.%s=" % ext]
+        for key in sorted(self.config):
+            args += ["--config", "%s=%s" % (key, self.config[key])]
+        return args
+
+    def extend(self, extensions=None, config=None):
+        """Return a copy of this profile with additional settings."""
+        cfg = dict(self.config)
+        cfg.update(config or {})
+        return Profile(self.plain, self.hgrcpath,
+                       self.extensions + list(extensions or []), cfg,
+                       self.env)
+
+
+class Capabilities(object):
+    """
+        What a Mercurial executable supports.
+
+        version is the version string and version_info its numbers as a
+        tuple. commands maps each command name to the frozenset of the
+        long names of its options, template_keywords and
+        template_filters are the documented template keywords and
+        filters, and bundle_compressions the bundle compression engines.
+        See Repo.capabilities.
+    """
+
+    def __init__(self, version, commands, template_keywords=(),
+                 template_filters=(), bundle_compressions=()):
+        self.version = version
+        self.version_info = tuple(
+            int(part) for part in re.findall("\\d+", version.split("+")[0]))
+        self.commands = dict((command, frozenset(options))
+                             for command, options in commands.items())
+        self.template_keywords = frozenset(template_keywords)
+        self.template_filters = frozenset(template_filters)
+        self.bundle_compressions = frozenset(bundle_compressions)
+
+    def supports(self, command, option=None):
+        """Return True if command exists and, if given, has option."""
+        options = self.commands.get(command)
+        if options is None:
+            return False
+        return option is None or option in options
+
+    def to_dict(self):
+        return {"version": self.version,
+                "commands": dict((command, sorted(options)) for
+                                 command, options in self.commands.items()),
+                "template_keywords": sorted(self.template_keywords),
+                "template_filters": sorted(self.template_filters),
+                "bundle_compressions": sorted(self.bundle_compressions)}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values["version"], values["commands"],
+                   values["template_keywords"], values["template_filters"],
+                   values["bundle_compressions"])
+
+    @staticmethod
+    def parse_version(out):
+        """Parse the output of hg version."""
+        match = re.search("\\s\\(version (.*)\\)$", out.split("\n")[0])
+        return match.group(1)
+
+    @staticmethod
+    def parse_commands(out):
+        """Parse the output of hg debugcommands."""
+        commands = {}
+        for line in out.splitlines():
+            match = re.match("^(.+?):(?: (.*))?$", line)
+            if match:
+                options = (match.group(2) or "").split(",")
+                commands[match.group(1)] = [option.strip() for option
+                                            in options if option.strip()]
+        return commands
+
+    @staticmethod
+    def parse_help(out, section):
+        """
+            Parse the names listed in a section of a hg help topic, such
+            as the Keywords section of 'hg help templates'.
+        """
+        lines = out.splitlines()
+        names, inside = [], False
+        for line, underline in zip(lines, lines[1:] + [""]):
+            if underline.strip() and set(underline.strip()) == set("="):
+                inside = line.strip() == section
+                continue
+            if not inside:
+                continue
+            # entries are indented names followed by two spaces, a colon
+            # or the end of the line, description lines are indented more
+            match = re.match("^    \"?([a-z_][a-z0-9_]*)\"?(:|  |$)", line)
+            if match:
+                names.append(match.group(1))
+        return names
 
 
 class Revision(object):
@@ -65,57 +793,625 @@ class Revision(object):
         return self.node == other.node
 
 
+class RevisionSequence(Sequence):
+    """
+        A lazy, read-only list of the Revision objects of a range.
+
+        start and stop are revision identifiers, both included as in
+        hg log -r start:stop, and step selects every step-th revision of
+        the range. Nothing is run until the sequence is used: len() only
+        lists the revision numbers, and revisions are fetched page_size
+        at a time as they are accessed, the pages being cached.
+    """
+
+    def __init__(self, repo, start=0, stop="tip", step=None, page_size=100):
+        self._repo = repo
+        self._bounds = (start, stop, step)
+        self._range = None
+        self._pages = {}
+        self.page_size = page_size
+
+    @property
+    def revs(self):
+        """The revision numbers of the sequence as a list."""
+        if self._range is None:
+            start, stop, step = self._bounds
+            start = 0 if start is None else start
+            stop = "tip" if stop is None else stop
+            # listed rather than computed from the endpoints, as hidden
+            # changesets leave gaps in the numbers
+            out = self._repo.hg_command("log", "-r",
+                                        "(%s):(%s)" % (start, stop),
+                                        "--template", "{rev}\\n")
+            self._range = [int(rev) for rev in out.split()][::step or 1]
+        return self._range
+
+    def _page(self, number):
+        page = self._pages.get(number)
+        if page is None:
+            revs = self.revs[number * self.page_size:
+                             (number + 1) * self.page_size]
+            if abs(revs[-1] - revs[0]) == len(revs) - 1:
+                identifier = "%d:%d" % (revs[0], revs[-1])
+            else:
+                identifier = "+".join(str(rev) for rev in revs)
+            out = self._repo.hg_log(identifier=identifier,
+                                    template=self._repo.rev_log_tpl)
+            page = [Revision(entry) for entry in out.split('\n')[:-1]]
+            self._pages[number] = page
+        return page
+
+    def __len__(self):
+        return len(self.revs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            view = RevisionSequence(self._repo, page_size=self.page_size)
+            view._range = self.revs[index]
+            return view
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("revision index out of range")
+        page, offset = divmod(index, self.page_size)
+        return self._page(page)[offset]
+
+    def __iter__(self):
+        for number in range((len(self) + self.page_size - 1) //
+                            self.page_size):
+            for revision in self._page(number):
+                yield revision
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, RevisionSequence)):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class Backend(object):
+    """
+        Runs the hg commands of Repo objects.
+
+        run() returns the output of a command and run_iter() yields it
+        line by line; both take the arguments of Repo.command and
+        Repo.command_iter and raise HgException on error. Set
+        Repo.backend, or pass backend to Repo, to change how commands
+        are run; hgapi.backend has a persistent command server backend
+        and backends recording and replaying outputs.
+    """
+
+    def run(self, path, env, *args, **kwargs):
+        """Run a hg command in path and return the result."""
+        raise NotImplementedError
+
+    def run_iter(self, path, env, *args, **kwargs):
+        """Run a hg command in path and yield the output line by line."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the processes or files held by the backend."""
+
+
+class SubprocessBackend(Backend):
+    """Run each command in a new hg process, see Repo.command."""
+
+    def run(self, path, env, *args, **kwargs):
+        return Repo.command(path, env, *args, **kwargs)
+
+    def run_iter(self, path, env, *args, **kwargs):
+        return Repo.command_iter(path, env, *args, **kwargs)
+
+
 class Repo(object):
     """A representation of a Mercurial repository."""
 
-    def __init__(self, path, user=None):
-        """Create a Repo object from the repository at path."""
+    #: Executable used to run Mercurial. None means auto-detect: use
+    #: chg (the Mercurial command server client) when it is on PATH and
+    #: works, otherwise hg. Set on the class to change the process default.
+    executable = None
+
+    #: Default execution profile: the inherited environment with user
+    #: configuration loaded.
+    profile = Profile(plain=False, hgrcpath=None)
+
+    #: Fast-start profile that ignores global and user configuration and
+    #: sets HGPLAIN; use extend() to whitelist extensions.
+    HERMETIC = Profile()
+
+    PRIORITY_INTERACTIVE = PRIORITY_INTERACTIVE
+    PRIORITY_NORMAL = PRIORITY_NORMAL
+    PRIORITY_BACKGROUND = PRIORITY_BACKGROUND
+
+    #: Process-wide scheduler all commands go through. Unlimited by
+    #: default, use Repo.scheduler.configure() to set limits.
+    scheduler = Scheduler()
+
+    #: Scheduling priority of commands run by this repo. Commands talking
+    #: to remote repositories always run with PRIORITY_BACKGROUND.
+    priority = PRIORITY_NORMAL
+
+    #: Default timeout in seconds for each command run by this repo.
+    timeout = None
+
+    #: Serialize commands writing to the repository through an in-process
+    #: lock per repository path before spawning hg.
+    serialize_writes = False
+
+    #: Seconds hg waits for a repository or working copy lock before
+    #: failing with HgLockException (hg's ui.timeout). None keeps hg's
+    #: default.
+    lock_timeout = None
+
+    #: Number of times a write failing on a held lock is retried, and the
+    #: initial delay between retries in seconds, doubled on each retry.
+    lock_retries = 0
+    lock_backoff = 0.1
+
+    #: Backend running the commands, a new hg process per command by
+    #: default. Set on the class to change the process default.
+    backend = SubprocessBackend()
+
+    #: File caching the capabilities of Mercurial executables across
+    #: processes, None to only cache them in memory.
+    capabilities_cache = os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or
+        os.path.join(os.path.expanduser("~"), ".cache"),
+        "hgapi", "capabilities.json")
+
+    def __init__(self, path, user=None, executable=None, profile=None,
+                 priority=None, timeout=None, serialize_writes=None,
+                 lock_timeout=None, lock_retries=None, lock_backoff=None,
+                 backend=None):
+        """
+            Create a Repo object from the repository at path.
+
+            executable overrides the Mercurial executable for this repo,
+            e.g. "hg", "chg" or a full path. profile overrides the
+            execution Profile, e.g. Repo.HERMETIC. priority sets the
+            scheduling priority, e.g. Repo.PRIORITY_INTERACTIVE. timeout
+            sets the default timeout in seconds for every command.
+            serialize_writes, lock_timeout, lock_retries and lock_backoff
+            control how writes handle lock contention, see
+            hg_write_command. backend overrides the Backend running the
+            commands of this repo.
+        """
         self.path = path
         self.cfg = False
         self.user = user
+        self._bundles = {}
+        self._store_path = None
+        if executable is not None:
+            self.executable = executable
+        if profile is not None:
+            self.profile = profile
+        if priority is not None:
+            self.priority = priority
+        if timeout is not None:
+            self.timeout = timeout
+        if serialize_writes is not None:
+            self.serialize_writes = serialize_writes
+        if lock_timeout is not None:
+            self.lock_timeout = lock_timeout
+        if lock_retries is not None:
+            self.lock_retries = lock_retries
+        if lock_backoff is not None:
+            self.lock_backoff = lock_backoff
+        if backend is not None:
+            self.backend = backend
+
+    @property
+    def _env(self):
+        return self.profile.env
+
+    @staticmethod
+    def probe_executable(executable):
+        """
+            Return True if executable can run Mercurial.
 
-    _env = os.environ.copy()
-    _env[str('LANG')] = str('en_US')
+            The probe runs 'version' once per executable and process, the
+            result is cached for subsequent calls.
+        """
+        with _probe_lock:
+            if executable not in _probed_executables:
+                try:
+                    proc = Popen([executable, "version", "-q"],
+                                 stdout=PIPE, stderr=PIPE)
+                    proc.communicate()
+                    works = proc.returncode == 0
+                except OSError:
+                    works = False
+                _probed_executables[executable] = works
+            return _probed_executables[executable]
 
     @classmethod
-    def command(cls, path, env, *args):
+    def detect_executable(cls):
         """
-            Run a hg command in path and return the result.
+            Return the executable to use when none is configured.
 
-            Raise on error.
+            chg is preferred when found on PATH and the probe succeeds,
+            since it avoids the Python startup cost of every hg call.
+            Falls back to hg. Detection is done once per process.
         """
-        cmd = ["hg", "--cwd", path, "--encoding", "UTF-8"] + list(args)
-        proc = Popen(cmd,
-                     stdout=PIPE, stderr=PIPE, env=env)
+        if not _detected_executable:
+            chg = _which("chg")
+            if chg is not None and cls.probe_executable(chg):
+                _detected_executable.append(chg)
+            else:
+                _detected_executable.append("hg")
+        return _detected_executable[0]
 
-        out, err = [x.decode("utf-8", "replace") for x in proc.communicate()]
+    @staticmethod
+    def _executable_key(executable):
+        """
+            Return a key identifying the installed executable by its path
+            and modification time, or None if it is not found. chg runs
+            the hg found on PATH, which is part of the key too.
+        """
+        names = [executable]
+        if os.path.basename(executable).startswith("chg"):
+            names.append(os.environ.get("CHGHG") or "hg")
+        key = []
+        for name in names:
+            path = name if os.path.dirname(name) else _which(name)
+            if path is None:
+                return None
+            try:
+                stat = os.stat(os.path.realpath(path))
+            except OSError:
+                return None
+            key.append("%s:%d" % (os.path.realpath(path),
+                                  int(stat.st_mtime * 1000000)))
+        return " ".join(key)
 
-        if proc.returncode:
+    @classmethod
+    def _probe_capabilities(cls, executable, backend):
+        profile = cls.HERMETIC
+        commands = [["version"], ["debugcommands"], ["help", "templates"],
+                    ["help", "bundlespec"]]
+
+        def run(args):
+            try:
+                return backend.run(".", profile.env, *(profile.args + args),
+                                   executable=executable)
+            except HgException:
+                if args[0] != "help":
+                    raise
+                return ""  # a help topic older versions do not have
+
+        outputs = _map_concurrently(run, commands, len(commands))
+        version, commands, templates, bundlespec = outputs
+        return Capabilities(
+            Capabilities.parse_version(version),
+            Capabilities.parse_commands(commands),
+            Capabilities.parse_help(templates, "Keywords"),
+            Capabilities.parse_help(templates, "Filters"),
+            Capabilities.parse_help(bundlespec,
+                                    "Available Compression Engines"))
+
+    @classmethod
+    def capabilities(cls, executable=None, backend=None):
+        """
+            Return the Capabilities of executable (by default the one
+            configured on the class, or detected), probed through backend
+            (by default Repo.backend).
+
+            Mercurial is probed once per executable and process, with a
+            few concurrent hg calls, and the result saved in
+            capabilities_cache keyed by the path and modification time of
+            the executable, so the following processes do not run hg
+            until it is upgraded. A failed probe is not retried in the
+            process: its HgException is raised again.
+        """
+        executable = executable or cls.executable or \
+            cls.detect_executable()
+        key = cls._executable_key(executable)
+        cache = cls.capabilities_cache if key is not None else None
+        key = key or executable
+        with _capabilities_lock:
+            capabilities = _capabilities.get(key)
+            if capabilities is None:
+                capabilities = cls.__load_capabilities(
+                    executable, backend or cls.backend, cache, key)
+                _capabilities[key] = capabilities
+        if isinstance(capabilities, HgException):
+            raise type(capabilities)(
+                "%s" % capabilities, exit_code=capabilities.exit_code,
+                out=capabilities.out, err=capabilities.err)
+        return capabilities
+
+    @classmethod
+    def __load_capabilities(cls, executable, backend, cache, key):
+        """Return the cached or probed Capabilities, or the HgException."""
+        stored = {}
+        if cache is not None:
+            try:
+                with open(cache, "rb") as source:
+                    stored = json.loads(source.read().decode("utf-8"))
+            except (IOError, OSError, ValueError):
+                stored = {}
+        if key in stored:
+            return Capabilities.from_dict(stored[key])
+        try:
+            capabilities = cls._probe_capabilities(executable, backend)
+        except HgException as ex:
+            return ex
+        if cache is not None:
+            stored[key] = capabilities.to_dict()
+            _save_json(cache, stored)
+        return capabilities
+
+    @classmethod
+    def _probed(cls, executable=None, backend=None):
+        """
+            Return the Capabilities of executable probed through backend,
+            or None if they could not be probed.
+        """
+        try:
+            return cls.capabilities(executable, backend)
+        except HgException:
+            return None
+
+    def _supports_compression(self, compression):
+        capabilities = self._probed(self.executable, self.backend)
+        return capabilities is None or \
+            not capabilities.bundle_compressions or \
+            compression in capabilities.bundle_compressions
+
+    def _supports(self, command, option=None):
+        """
+            Return True if the Mercurial of this repo supports command and
+            option, or could not be probed, in which case a recent one is
+            assumed.
+        """
+        capabilities = self._probed(self.executable, self.backend)
+        return capabilities is None or capabilities.supports(command, option)
+
+    @staticmethod
+    def _spawn(cmd, env, group=False, stdin=None, stdout=PIPE, stderr=PIPE):
+        """
+            Start cmd. With group set, the process leads a new process
+            group so that the whole tree can be terminated.
+        """
+        options = {}
+        if group and os.name == "posix":
+            if sys.version_info >= (3, 2):
+                options["start_new_session"] = True
+            else:
+                options["preexec_fn"] = os.setsid
+        elif group and sys.platform == "win32":
+            import subprocess
+            options["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        try:
+            proc = Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr,
+                         env=env, **options)
+        except OSError as ex:
+            raise HgException("Error running %s: %s" % (" ".join(cmd), ex))
+        proc.hgapi_group = group
+        return proc
+
+    @classmethod
+    def _prepare(cls, path, args, kwargs):
+        """Pop the execution options from kwargs and build the command."""
+        executable = (kwargs.pop("executable", None) or cls.executable or
+                      cls.detect_executable())
+        options = {"priority": kwargs.pop("priority", PRIORITY_NORMAL),
+                   "deadline": _get_deadline(kwargs.pop("timeout", None)),
+                   "cancel": kwargs.pop("cancel", None),
+                   "stdin": kwargs.pop("stdin", None),
+                   "stdout": kwargs.pop("stdout", None),
+                   "merge_stderr": kwargs.pop("merge_stderr", False)}
+        if kwargs:
+            raise TypeError("Unexpected arguments: %s" % ", ".join(kwargs))
+        cmd = [executable, "--cwd", path, "--encoding", "UTF-8"] + list(args)
+        return cmd, options
+
+    _lock_error = re.compile("timed out waiting for lock held by")
+
+    @classmethod
+    def _check_result(cls, cmd, returncode, out, err):
+        if returncode:
             cmd = " ".join(cmd)
-            raise HgException("Error running %s:\n"
-                              "\tErr: %s\n"
-                              "\tOut: %s\n"
-                              "\tExit: %s"
-                              % (cmd, err, out, proc.returncode),
-                              exit_code=proc.returncode)
+            error = HgException
+            # errors are part of out when stderr was merged
+            if cls._lock_error.search(err or out):
+                error = HgLockException
+            raise error("Error running %s:\n"
+                        "\tErr: %s\n"
+                        "\tOut: %s\n"
+                        "\tExit: %s"
+                        % (cmd, err, out, returncode),
+                        exit_code=returncode, out=out, err=err)
+
+    @classmethod
+    def command(cls, path, env, *args, **kwargs):
+        """
+            Run a hg command in path and return the result.
+
+            Keyword arguments:
+
+            executable overrides the executable configured on the class.
+            priority sets the scheduling priority (default
+            PRIORITY_NORMAL). timeout is the number of seconds after which
+            the process tree is terminated and HgTimeoutException raised;
+            a deadline() set for the thread also applies. cancel is a
+            CancelToken that terminates the process when cancelled. stdin
+            is bytes or a binary file object to use as standard input;
+            file objects are streamed, not read into memory. stdout is a
+            writable binary file object receiving the output, in which
+            case an empty string is returned. With merge_stderr set,
+            errors and warnings are returned along with the output.
 
+            Raise on error.
+        """
+        cmd, options = cls._prepare(path, args, kwargs)
+        deadline, cancel = options["deadline"], options["cancel"]
+        stdin, data, feed = _stdin_source(options["stdin"])
+        stdout, sink = PIPE, options["stdout"]
+        if sink is not None and _has_fileno(sink):
+            sink.flush()
+            stdout, sink = sink, None
+        with cls.scheduler.slot(path, options["priority"], deadline):
+            group = deadline is not None or cancel is not None
+            stderr = STDOUT if options["merge_stderr"] else PIPE
+            proc = cls._spawn(cmd, env, group, stdin, stdout, stderr)
+            watchdog = _Watchdog(proc, deadline, cancel)
+            # communicate() must not touch the pipes copied by threads
+            if feed is not None:
+                feeder = _feed(feed, proc.stdin)
+                proc.stdin = None
+            if sink is not None:
+                copier = _feed(proc.stdout, sink, close=False)
+                proc.stdout = None
+            try:
+                out, err = [(x or b"").decode("utf-8", "replace")
+                            for x in proc.communicate(data)]
+            finally:
+                watchdog.stop()
+                if feed is not None:
+                    feeder.join()
+                if sink is not None:
+                    copier.join()
+
+        watchdog.check(cmd)
+        cls._check_result(cmd, proc.returncode, out, err)
         return out
 
+    @classmethod
+    def command_iter(cls, path, env, *args, **kwargs):
+        """
+            Run a hg command in path and yield the output line by line.
+
+            Takes the same keyword arguments as command, and chunk_size to
+            yield the raw output in bytes chunks of that size instead of
+            lines. Closing the generator early, an expired timeout or a
+            cancelled CancelToken terminate the process immediately and
+            free its slot.
+
+            Raise on error.
+        """
+        chunk_size = kwargs.pop("chunk_size", None)
+        cmd, options = cls._prepare(path, args, kwargs)
+        deadline, cancel = options["deadline"], options["cancel"]
+        with cls.scheduler.slot(path, options["priority"], deadline):
+            proc = cls._spawn(cmd, env, True)
+            watchdog = _Watchdog(proc, deadline, cancel)
+            errors = []
+            drain = threading.Thread(
+                target=lambda: errors.append(proc.stderr.read()))
+            drain.daemon = True
+            drain.start()
+            try:
+                if chunk_size:
+                    for chunk in iter(lambda: proc.stdout.read(chunk_size),
+                                      b""):
+                        yield chunk
+                else:
+                    for line in iter(proc.stdout.readline, b""):
+                        yield line.decode("utf-8", "replace")
+            finally:
+                if proc.poll() is None:
+                    # stopped before the end of the output
+                    _kill(proc)
+                proc.stdout.close()
+                drain.join()
+                proc.wait()
+                watchdog.stop()
+
+        watchdog.check(cmd)
+        err = b"".join(errors).decode("utf-8", "replace")
+        cls._check_result(cmd, proc.returncode, "", err)
+
     def __getitem__(self, rev=slice(0, 'tip')):
         """
             Get a Revision object for the revision identified by rev.
 
             rev can be a range (6c31a9f7be7ac58686f0610dd3c4ba375db2472c:tip)
             a single changeset id or it can be left blank to indicate
-            the entire history.
+            the entire history. A range gives a lazy RevisionSequence,
+            fetching the revisions as they are used.
         """
         if isinstance(rev, slice):
-            return self.revisions(rev)
+            return RevisionSequence(self, rev.start, rev.stop, rev.step)
         return self.revision(rev)
 
-    def hg_command(self, *args):
-        """Run a hg command."""
-        return Repo.command(self.path, self._env, *args)
+    def hg_command(self, *args, **kwargs):
+        """
+            Run a hg command.
+
+            Keyword arguments are passed on to Repo.command, or the
+            run() method of the configured backend.
+        """
+        args = self.profile.args + list(args)
+        self._command_defaults(kwargs)
+        return self.backend.run(self.path, self._env, *args, **kwargs)
+
+    def hg_command_iter(self, *args, **kwargs):
+        """
+            Run a hg command, yielding its output line by line.
+
+            Keyword arguments are passed on to Repo.command_iter, or the
+            run_iter() method of the configured backend.
+        """
+        args = self.profile.args + list(args)
+        self._command_defaults(kwargs)
+        return self.backend.run_iter(self.path, self._env, *args, **kwargs)
+
+    def hg_write_command(self, *args, **kwargs):
+        """
+            Run a hg command that takes the repository or working copy
+            lock.
+
+            With serialize_writes set, writes from this process to the
+            same repository wait for each other instead of contending for
+            hg's lock; reads are never serialized. A write failing with
+            HgLockException is retried lock_retries times, waiting
+            lock_backoff seconds before the first retry and doubling the
+            wait on each following one. A stdin file object is rewound to
+            its starting position before a retry; a stream that cannot be
+            rewound is not retried, as the failed attempt consumed it.
+        """
+        if self.lock_timeout is not None:
+            args = ("--config", "ui.timeout=%d" % self.lock_timeout) + args
+        retries = self.lock_retries
+        stdin = kwargs.get("stdin")
+        position = None
+        if retries and stdin is not None and not isinstance(stdin, bytes):
+            position = _tell(stdin)
+            if position is None:
+                retries = 0
+        attempt = 0
+        while True:
+            try:
+                if self.serialize_writes:
+                    with _write_lock(self.path):
+                        return self.hg_command(*args, **kwargs)
+                return self.hg_command(*args, **kwargs)
+            except HgLockException:
+                if attempt >= retries:
+                    raise
+                time.sleep(self.lock_backoff * 2 ** attempt)
+                attempt += 1
+                if position is not None:
+                    stdin.seek(position)
+
+    def _command_defaults(self, kwargs):
+        kwargs.setdefault("executable", self.executable)
+        kwargs.setdefault("priority", self.priority)
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
 
     def hg_init(self):
         """Initialize a new repo."""
@@ -132,16 +1428,67 @@ class Repo(object):
         str_rev = res.strip("\n +")
         return int(str_rev)
 
+    #: Maximum total length of the file arguments passed to a single hg
+    #: call by the bulk operations; None uses a limit derived from the
+    #: operating system's.
+    max_arg_length = None
+
+    def __bulk_command(self, args, paths, report, tail=(), failure=None):
+        """
+            Run a write command on many paths, as few times as the command
+            line length allows, and return a path -> bool dict telling for
+            each path if it was reported by the regular expression report,
+            and not by failure.
+        """
+        root = os.path.realpath(self.path)
+
+        def normalize(path):
+            if os.path.isabs(path):
+                path = os.path.relpath(os.path.realpath(path), root)
+            return os.path.normpath(path)
+
+        # paths starting with a dash are not options after "--"
+        args = args + ["--"]
+        executable = (self.executable or Repo.executable or
+                      Repo.detect_executable())
+        fixed = ([executable, "--cwd", self.path, "--encoding", "UTF-8"] +
+                 self.profile.args + args + list(tail))
+        reported, failed = set(), set()
+        for chunk in _arg_chunks(paths, fixed, self.max_arg_length):
+            try:
+                out = self.hg_write_command(*(args + chunk + list(tail)),
+                                            merge_stderr=True)
+            except HgException as ex:
+                # hg exits with 1 when some of the files failed
+                if ex.exit_code != 1 or ex.out is None:
+                    raise
+                out = ex.out
+            reported.update(os.path.normpath(match)
+                            for match in re.findall(report, out, re.M))
+            if failure is not None:
+                failed.update(os.path.normpath(match)
+                              for match in re.findall(failure, out, re.M))
+        return dict((path, normalize(path) in reported and
+                     normalize(path) not in failed) for path in paths)
+
     def hg_add(self, filepath=None):
         """
             Add a file to the repo.
 
             when no filepath is given, all files are added to the repo.
+
+            filepath can also be a list of files, which are added with as
+            few hg calls as the command line length allows; a dict is
+            returned telling for each file if it was added.
         """
+        if isinstance(filepath, (list, tuple)):
+            return self.__bulk_command(["add", "-v"], filepath,
+                                       "^adding (.*)$",
+                                       failure="^(.*) already tracked!$")
         if filepath is None:
-            self.hg_command("add")
+            self.hg_write_command("add")
         else:
-            self.hg_command("add", filepath)
+            self.hg_write_command("add", filepath)
 
     def hg_addremove(self, filepath=None):
         """
@@ -149,19 +1496,42 @@ class Repo(object):
 
             When no filepath is given, all files are added and removed
             to and respectively from the repo.
+
+            filepath can also be a list of files, see hg_add; the dict
+            returned tells for each file if it was added or removed.
         """
+        if isinstance(filepath, (list, tuple)):
+            return self.__bulk_command(["addremove", "-v"], filepath,
+                                       "^(?:adding|removing) (.*)$")
         if filepath is None:
-            self.hg_command("addremove")
+            self.hg_write_command("addremove")
         else:
-            self.hg_command("addremove", filepath)
+            self.hg_write_command("addremove", filepath)
 
     def hg_remove(self, filepath):
-        """Remove a file from the repo"""
-        self.hg_command("remove", filepath)
+        """
+            Remove a file from the repo
+
+            filepath can also be a list of files, see hg_add; the dict
+            returned tells for each file if it was removed.
+        """
+        if isinstance(filepath, (list, tuple)):
+            return self.__bulk_command(["remove", "-v"], filepath,
+                                       "^removing (.*)$")
+        self.hg_write_command("remove", filepath)
 
     def hg_move(self, source, destination):
-        """Move a file in the repo."""
-        self.hg_command("move", source, destination)
+        """
+            Move a file in the repo.
+
+            source can also be a list of files, which are moved into the
+            directory destination, see hg_add; the dict returned tells for
+            each file if it was moved.
+        """
+        if isinstance(source, (list, tuple)):
+            return self.__bulk_command(["move", "-v"], source,
+                                       "^moving (.*) to .*$", [destination])
+        self.hg_write_command("move", source, destination)
 
     def hg_rename(self, source, destination):
         """
@@ -175,7 +1545,7 @@ class Repo(object):
         cmd = ["update", str(reference)]
         if clean:
             cmd.append("--clean")
-        self.hg_command(*cmd)
+        self.hg_write_command(*cmd)
 
     def hg_tag(self, *tags, **kwargs):
         """
@@ -190,7 +1560,7 @@ class Repo(object):
         cmd = ['tag'] + list(tags)
         if rev:
             cmd += ['-r', str(rev)]
-        self.hg_command(*cmd)
+        self.hg_write_command(*cmd)
 
     def hg_tags(self):
         """
@@ -228,7 +1598,7 @@ class Repo(object):
             containing all revisions that would have been merged.
         """
         if not preview:
-            return self.hg_command("merge", reference)
+            return self.hg_write_command("merge", reference)
         else:
             revno_re = re.compile('^changeset: (\d+):\w+$')
             out = self.hg_command("merge", "-P", reference)
@@ -245,7 +1615,54 @@ class Repo(object):
             cmd = ["revert", "--all"]
         else:
             cmd = ["revert"] + list(files)
-        self.hg_command(*cmd)
+        self.hg_write_command(*cmd)
+
+    #: Files whose stat information makes up fingerprint(), in the .hg
+    #: directory and in the store.
+    FINGERPRINT_FILES = ("bookmarks", "dirstate", "branch", "hgrc",
+                         "localtags")
+    FINGERPRINT_STORE_FILES = ("00changelog.i", "00changelog.d",
+                               "00changelog.n", "phaseroots", "obsstore")
+
+    def _store(self):
+        hgdir = os.path.join(self.path, ".hg")
+        try:
+            with open(os.path.join(hgdir, "sharedpath"), "rb") as shared:
+                source = shared.read().decode("utf-8").strip()
+        except (IOError, OSError):
+            return os.path.join(hgdir, "store")
+        # a share uses the store of its source
+        return os.path.join(hgdir, source, "store")
+
+    def fingerprint(self):
+        """
+            Return a token that changes when the repository changes:
+            new changesets, phases, bookmarks, branch, configuration or
+            working copy state.
+
+            The token is built from the size, modification time and inode
+            of the files holding that state, without running hg, so it
+            is cheap to compare with a previous one before refreshing
+            anything derived from the repository. It is not meant to be
+            compared across machines or stored.
+        """
+        if self._store_path is None:
+            self._store_path = self._store()
+        hgdir = os.path.join(self.path, ".hg")
+        token = []
+        for directory, names in ((hgdir, self.FINGERPRINT_FILES),
+                                 (self._store_path,
+                                  self.FINGERPRINT_STORE_FILES)):
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except OSError:
+                    token.append(None)
+                    continue
+                token.append((stat.st_size,
+                              getattr(stat, "st_mtime_ns", stat.st_mtime),
+                              stat.st_ino))
+        return tuple(token)
 
     def hg_node(self):
         """Get the full node id of the current revision."""
@@ -269,21 +1686,266 @@ class Repo(object):
         # consider the files arg, committing all files instead of what
         # was passed in files kwarg
         args = [arg for arg in args if arg]
-        self.hg_command("commit", msg[0], msg[1], *args)
+        self.hg_write_command("commit", msg[0], msg[1], *args)
+
+    def hg_import(self, patches, bypass=False, exact=False, timeout=None):
+        """
+            Apply patches in hg export format, committing each of them.
+
+            patches is a file name, a list of file names, or a readable
+            binary file object, which is streamed to hg through its
+            standard input. A file may hold several concatenated patches.
+            With bypass set, the patches are applied on top of the working
+            copy parent without touching the working copy; exact applies
+            them to the parents they were exported from.
 
-    def hg_push(self, destination=None):
+            Returns the full nodes of the created changesets.
+        """
+        cmds = ["import"]
+        if bypass:
+            cmds.append("--bypass")
+        if exact:
+            cmds.append("--exact")
+        tip = int(self.hg_log(identifier="tip", template="{rev}"))
+        if hasattr(patches, "read"):
+            self.hg_write_command(*(cmds + ["-"]), stdin=patches,
+                                  timeout=timeout)
+        else:
+            if not isinstance(patches, (list, tuple)):
+                patches = [patches]
+            self.hg_write_command(*(cmds + list(patches)), timeout=timeout)
+        revset = "all() - :%d" % tip if tip >= 0 else "all()"
+        return self.hg_log(identifier=revset,
+                           template="{node}\n").split()
+
+    def hg_commit_pipeline(self, changes, batch_size=1000, timeout=None):
+        """
+            Commit a sequence of changes, many per hg process.
+
+            changes is an iterable of (files, message, user, date) tuples.
+            files maps paths to their new contents (bytes, or text encoded
+            as UTF-8) or to None to remove them. user and date may be None
+            to use the repository user and the current time; date takes
+            any format hg accepts. The changes are turned into patches and
+            applied with hg import on top of the working copy, which must
+            be clean, batch_size changesets per call; the changes are read
+            lazily, one batch at a time. timeout applies to each batch.
+
+            Returns the full nodes of the created changesets, one per
+            change. ValueError is raised for a change without files or
+            removing an untracked file, and HgException when a change
+            leaves the files as they were (hg import skips it); the
+            batches before are committed.
+        """
+        tracked = set(self.hg_command("manifest", "-r", ".").splitlines())
+        changes = iter(changes)
+        nodes = []
+        while True:
+            batch = list(itertools.islice(changes, batch_size))
+            if not batch:
+                return nodes
+            patches = io.BytesIO()
+            for files, message, user, date in batch:
+                patches.write(_changeset_patch(files, message,
+                                               user or self.user, date,
+                                               tracked))
+            patches.seek(0)
+            created = self.hg_import(patches, timeout=timeout)
+            nodes += created
+            if len(created) != len(batch):
+                raise HgException("%d changesets created for %d changes, "
+                                  "changes modifying nothing are skipped"
+                                  % (len(created), len(batch)))
+
+    def hg_push(self, destination=None, timeout=None):
         """Push changes from this repo."""
         if destination is None:
-            self.hg_command("push")
+            self.hg_command("push", priority=PRIORITY_BACKGROUND,
+                            timeout=timeout)
         else:
-            self.hg_command("push", destination)
+            self.hg_command("push", destination,
+                            priority=PRIORITY_BACKGROUND, timeout=timeout)
 
-    def hg_pull(self, source=None):
-        """Pull changes to this repo."""
+    def hg_pull(self, source=None, timeout=None, use_bundle=True):
+        """
+            Pull changes to this repo.
+
+            If hg_incoming saved a bundle for source, the changes are
+            applied from it instead of being downloaded again (changes
+            pushed to the remote since are not pulled), then the phases
+            and bookmarks, which bundles do not carry, are pulled from the
+            remote. Set use_bundle to False to always pull everything from
+            the remote.
+        """
+        saved = self._bundles.pop(source or "default", None)
+        if saved is not None:
+            bundle, heads = saved
+            try:
+                if use_bundle:
+                    self.hg_command("pull", bundle, timeout=timeout)
+                    # only the heads, all known now: no changeset is
+                    # transferred again
+                    args = ["pull"]
+                    for head in heads:
+                        args += ["--rev", head]
+                    if source is not None:
+                        args.append(source)
+                    self.hg_command(*args, priority=PRIORITY_BACKGROUND,
+                                    timeout=timeout)
+                    return
+            finally:
+                shutil.rmtree(os.path.dirname(bundle), ignore_errors=True)
         if source is None:
-            self.hg_command("pull")
+            self.hg_command("pull", priority=PRIORITY_BACKGROUND,
+                            timeout=timeout)
         else:
-            self.hg_command("pull", source)
+            self.hg_command("pull", source, priority=PRIORITY_BACKGROUND,
+                            timeout=timeout)
+
+    BUNDLE_COMPRESSIONS = ("none", "gzip", "bzip2", "zstd")
+
+    def hg_bundle(self, destination, base=None, revs=None, compression=None,
+                  all=False, timeout=None):
+        """
+            Create a bundle file of changesets.
+
+            destination is a file name or a writable binary file object.
+            A file object is written to through a named pipe where the
+            platform supports it, so no intermediate file is created.
+
+            base is a revision or list of revisions assumed to be present
+            at the receiving side, and revs a revision or list of
+            revisions to bundle along with their ancestors. With all set,
+            all changesets are bundled. Without base or all, the changes
+            missing from the default remote are bundled.
+
+            compression is one of BUNDLE_COMPRESSIONS ("zstd" only with a
+            Mercurial supporting it, ValueError is raised otherwise),
+            trading CPU time for size; None uses hg's default (bzip2).
+
+            Returns the number of changesets bundled. Nothing is written
+            when there are no changes.
+        """
+        cmds = ["bundle"]
+        if compression is not None:
+            if compression not in self.BUNDLE_COMPRESSIONS:
+                raise ValueError("Unknown bundle compression %s"
+                                 % compression)
+            if not self._supports_compression(compression):
+                raise ValueError("Bundle compression %s is not supported "
+                                 "by this Mercurial" % compression)
+            cmds += ["--type", "%s-v2" % compression]
+        if all:
+            cmds.append("--all")
+        for option, values in (("--base", base), ("--rev", revs)):
+            if values is None:
+                continue
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            for value in values:
+                cmds += [option, str(value)]
+        if hasattr(destination, "write"):
+            return self.__bundle_to_file(cmds, destination, timeout)
+        return self.__run_bundle(cmds + [destination], timeout)
+
+    def __run_bundle(self, cmds, timeout):
+        try:
+            out = self.hg_command(*cmds, timeout=timeout)
+        except HgException as ex:
+            if ex.exit_code == 1:  # no changes found
+                return 0
+            raise
+        match = re.search("(\\d+) changesets? found", out)
+        return int(match.group(1)) if match else 0
+
+    def __bundle_to_file(self, cmds, destination, timeout):
+        directory = tempfile.mkdtemp(prefix="hgapi-")
+        path = os.path.join(directory, "bundle.hg")
+        try:
+            if not hasattr(os, "mkfifo"):
+                count = self.__run_bundle(cmds + [path], timeout)
+                if count:
+                    with open(path, "rb") as bundle:
+                        shutil.copyfileobj(bundle, destination)
+                return count
+
+            os.mkfifo(path)
+            # open both ends here: opening the read end alone would block
+            # until hg opens the pipe, which it may never do, and holding
+            # a write end keeps the reader from seeing the end of the
+            # bundle before hg has written it
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            writer = None
+            try:
+                fcntl.fcntl(fd, fcntl.F_SETFL,
+                            fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+                writer = os.open(path, os.O_WRONLY)
+                bundle = os.fdopen(fd, "rb")
+            except Exception:
+                os.close(fd)
+                if writer is not None:
+                    os.close(writer)
+                raise
+            errors = []
+
+            def copy():
+                with bundle:
+                    try:
+                        shutil.copyfileobj(bundle, destination)
+                    except Exception as ex:
+                        errors.append(ex)
+                        # keep reading so that hg can finish
+                        while bundle.read(65536):
+                            pass
+
+            reader = threading.Thread(target=copy)
+            reader.daemon = True
+            reader.start()
+            try:
+                count = self.__run_bundle(cmds + [path], timeout)
+            finally:
+                # hg has exited: the reader gets the end of the pipe
+                os.close(writer)
+                reader.join()
+            if errors:
+                raise errors[0]
+            return count
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def hg_unbundle(self, source, update=False, timeout=None):
+        """
+            Apply a bundle to the repository.
+
+            source is a file name or a readable binary file object. A file
+            object is streamed to hg through /dev/stdin where available,
+            without an intermediate file, unless lock_retries is set and
+            the stream cannot be rewound for a retry. With update
+            set, the working copy is updated to the new tip.
+
+            Returns the number of changesets added.
+        """
+        cmds = ["unbundle"]
+        if update:
+            cmds.append("--update")
+        if not hasattr(source, "read"):
+            out = self.hg_write_command(*(cmds + [source]), timeout=timeout)
+        elif os.path.exists("/dev/stdin") and (
+                not self.lock_retries or _tell(source) is not None):
+            out = self.hg_write_command(*(cmds + ["/dev/stdin"]),
+                                        stdin=source, timeout=timeout)
+        else:
+            directory = tempfile.mkdtemp(prefix="hgapi-")
+            path = os.path.join(directory, "bundle.hg")
+            try:
+                with open(path, "wb") as bundle:
+                    shutil.copyfileobj(source, bundle)
+                out = self.hg_write_command(*(cmds + [path]),
+                                            timeout=timeout)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+        match = re.search("added (\\d+) changesets?", out)
+        return int(match.group(1)) if match else 0
 
     def hg_paths(self):
         """Get remote repositories."""
@@ -292,33 +1954,85 @@ class Repo(object):
 
         return dict(remotes_list)
 
-    def __get_remote_changes(self, command, remote):
-        if remote not in self.hg_paths().keys():
-            raise HgException("No such remote repository")
+    def __get_remote_changes(self, command, remote, timeout=None,
+                             options=()):
+        # paths are looked up in the cached configuration, which is only
+        # re-read when the remote is not found
+        if self.config("paths", remote) is None:
+            self.read_config()
+            if self.config("paths", remote) is None:
+                raise HgException("No such remote repository")
 
         try:
             result = self.hg_command(
                 command,
                 remote,
                 "--template",
-                self.rev_log_tpl
+                self.rev_log_tpl,
+                priority=PRIORITY_BACKGROUND,
+                timeout=timeout,
+                *options
             ).split("\n")
+        except (HgTimeoutException, HgCancelledException):
+            raise
         except HgException:
             return []
 
         changesets = [change for change in result if change.startswith("{")]
         return list(map(lambda revision: Revision(revision), changesets))
 
-    def hg_outgoing(self, remote="default"):
+    def hg_outgoing(self, remote="default", timeout=None):
         """Get outgoing changesets for a certain remote."""
-        return self.__get_remote_changes("outgoing", remote)
+        return self.__get_remote_changes("outgoing", remote, timeout)
+
+    def hg_incoming(self, remote="default", timeout=None, bundle=False):
+        """
+            Get incoming changesets for a certain remote.
+
+            With bundle set, the incoming changes are saved to a temporary
+            bundle, which the next hg_pull from the same remote applies
+            instead of downloading them again; only their phases and
+            bookmarks are then pulled from the remote. Call
+            discard_bundles to delete bundles that will not be pulled.
+        """
+        if not bundle:
+            return self.__get_remote_changes("incoming", remote, timeout)
+        directory = tempfile.mkdtemp(prefix="hgapi-")
+        path = os.path.join(directory, "incoming.hg")
+        try:
+            changes = self.__get_remote_changes("incoming", remote, timeout,
+                                                ("--bundle", path))
+        except HgException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        old = self._bundles.pop(remote, None)
+        if old is not None:
+            shutil.rmtree(os.path.dirname(old[0]), ignore_errors=True)
+        if changes and os.path.exists(path):
+            parents = set(parent for change in changes
+                          for parent in change.parents)
+            heads = [change.node for change in changes
+                     if change.rev not in parents]
+            self._bundles[remote] = (path, heads)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+        return changes
 
-    def hg_incoming(self, remote="default"):
-        """Get incoming changesets for a certain remote."""
-        return self.__get_remote_changes("incoming", remote)
+    def discard_bundles(self, remote=None):
+        """
+            Delete the bundle saved by hg_incoming for remote, or all the
+            saved bundles if remote is None.
+        """
+        if remote is None:
+            saved = list(self._bundles.values())
+            self._bundles.clear()
+        else:
+            saved = [self._bundles.pop(remote, None)]
+        for path, heads in filter(None, saved):
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
 
     def hg_log(self, identifier=None, limit=None, template=None,
-               branch=None, **kwargs):
+               branch=None, timeout=None, **kwargs):
         """Get repositiory log."""
         cmds = ["log"]
         if identifier:
@@ -332,9 +2046,155 @@ class Repo(object):
         if kwargs:
             for key in kwargs:
                 cmds += [key, kwargs[key]]
-        log = self.hg_command(*cmds)
+        log = self.hg_command(*cmds, timeout=timeout)
         return log
 
+    def hg_grep(self, pattern, revset=None, include=(), exclude=(),
+                ignore_case=False, shards=1, **kwargs):
+        """
+            Search files for the regular expression pattern (Python
+            syntax), yielding a (rev, path, line number, line) tuple for
+            each matching line as hg finds it.
+
+            revset (a string or a hgapi.Query) selects the revisions
+            whose files are searched; None searches the working directory
+            and gives None as rev. include and exclude restrict the search
+            to files matching hg -I and -X patterns. With shards other
+            than 1, the revisions are searched from that many concurrent
+            hg processes (see map_shards), the matches still being
+            yielded in revision order. Closing the generator stops the
+            search. Keyword arguments are passed on to hg_command_iter.
+        """
+        if shards != 1 and revset is not None:
+            for match in self.__grep_shards(pattern, revset, include,
+                                            exclude, ignore_case, shards,
+                                            kwargs):
+                yield match
+            return
+        args = ["grep", "--print0", "--line-number"]
+        if self._supports("grep", "all-files") and \
+                not self._supports("grep", "diff"):
+            # versions before --diff search changes by default
+            args.append("--all-files")
+        if ignore_case:
+            args.append("--ignore-case")
+        if revset is not None:
+            args += ["--rev", str(revset)]
+        for include_pattern in include:
+            args += ["-I", include_pattern]
+        for exclude_pattern in exclude:
+            args += ["-X", exclude_pattern]
+        args += ["--", pattern]
+        fields_count = 3 if revset is None else 4
+        fields, rest = [], b""
+        output = self.hg_command_iter(*args, chunk_size=65536, **kwargs)
+        try:
+            for chunk in output:
+                values = (rest + chunk).split(b"\0")
+                rest = values.pop()
+                for value in values:
+                    fields.append(value.decode("utf-8", "replace"))
+                    if len(fields) < fields_count:
+                        continue
+                    if revset is None:
+                        fields.insert(1, None)
+                    path, rev, line_number, line = fields
+                    fields = []
+                    yield (rev if rev is None else int(rev), path,
+                           int(line_number), line)
+        except HgException as error:
+            # hg grep exits with 1 when nothing matched
+            if error.exit_code != 1:
+                raise
+
+    def __grep_shards(self, pattern, revset, include, exclude, ignore_case,
+                      shards, kwargs):
+        # stop the other shards when the generator is closed, unless the
+        # caller manages cancellation
+        token = kwargs.pop("cancel", None)
+        owned = token is None
+        if owned:
+            token = CancelToken()
+        revsets = self.shard_revsets(revset, shards)
+        results = [queue.Queue() for _ in revsets]
+        done = object()
+
+        def search(revset, results):
+            try:
+                for match in self.hg_grep(pattern, revset, include, exclude,
+                                          ignore_case, cancel=token,
+                                          **kwargs):
+                    results.put(match)
+            except BaseException:
+                results.put(sys.exc_info()[1])
+            finally:
+                results.put(done)
+
+        for shard in zip(revsets, results):
+            thread = threading.Thread(target=search, args=shard)
+            thread.daemon = True
+            thread.start()
+        try:
+            for shard in results:
+                for match in iter(shard.get, done):
+                    if isinstance(match, BaseException):
+                        raise match
+                    yield match
+        finally:
+            if owned:
+                token.cancel()
+
+    #: Process-wide cache of hg_annotate results by (node, path); the
+    #: annotation of a file at a given changeset never changes.
+    annotate_cache = _LRUCache(1000)
+
+    def hg_annotate(self, paths, rev=".", timeout=None):
+        """
+            Annotate files as of revision rev, giving for each line the
+            changeset that introduced it.
+
+            paths is a file name or a list of file names, relative to the
+            repository root. Returns the list of AnnotatedLine of the file
+            for a single name, otherwise a dict of such lists by file
+            name. Binary files have no lines.
+
+            Results are cached in Repo.annotate_cache by node and file
+            name. Files not cached are annotated with as few hg calls as
+            the command line length allows.
+        """
+        single = not isinstance(paths, (list, tuple))
+        if single:
+            paths = [paths]
+        paths = [os.path.normpath(path).replace(os.sep, "/")
+                 for path in paths]
+        rev = str(rev)
+        if re.match("^[0-9a-f]{40}$", rev):
+            node = rev
+        else:
+            node = self.hg_log(identifier=rev, template="{node}").strip()
+        result = {}
+        missing = []
+        for path in paths:
+            lines = self.annotate_cache.get((node, path))
+            if lines is None:
+                missing.append(path)
+            else:
+                result[path] = lines
+        fixed = ["annotate", "--template", "json", "--rev", node, "--user",
+                 "--changeset", "--number", "--line-number", "--date",
+                 "--file", "--"]
+        for chunk in _arg_chunks(missing, fixed, self.max_arg_length):
+            out = self.hg_command(*(fixed + chunk), timeout=timeout)
+            for entry in json.loads(out):
+                lines = [AnnotatedLine(line["rev"], line["node"],
+                                       line["user"], tuple(line["date"]),
+                                       line["lineno"], line["path"],
+                                       line["line"])
+                         for line in entry.get("lines", [])]
+                self.annotate_cache.put((node, entry["path"]), lines)
+                result[entry["path"]] = lines
+        return result[paths[0]] if single else result
+
     def hg_branch(self, branch_name=None):
         """
             Create a branch or get a branch name.
@@ -413,17 +2273,17 @@ class Repo(object):
             cmds += ['--inactive']
             if name:
                 cmds += [name]
-            return self.hg_command(*cmds)
+            return self.hg_write_command(*cmds)
         elif name is not None:
             if action == Repo.BOOKMARK_DELETE:
                 cmds += ['--delete', name]
-                return self.hg_command(*cmds)
+                return self.hg_write_command(*cmds)
             elif action == Repo.BOOKMARK_RENAME and newname is not None:
                 cmds += ['--rename', name, newname]
-                return self.hg_command(*cmds)
+                return self.hg_write_command(*cmds)
             elif action == Repo.BOOKMARK_CREATE:
                 cmds += [name]
-                return self.hg_command(*cmds)
+                return self.hg_write_command(*cmds)
 
     def hg_diff(self, rev_a=None, rev_b=None, filenames=None):
         """
@@ -494,12 +2354,15 @@ class Repo(object):
             changes.setdefault(change, []).append(path)
         return changes
 
-    def hg_archive(self, destination, revision=None, archive_type=None):
+    def hg_archive(self, destination, revision=None, archive_type=None,
+                   timeout=None, include=None, exclude=None, prefix=None):
         """
             Archive a repository.
 
             Creates an archive of a single revision in the specified
-            destination.
+            destination, a path or a writable binary file object. File
+            objects receive the archive as hg produces it, which requires
+            an archive_type of tar, tbz2, tgz or zip.
 
             If revision is not supplied the default is the parent of the
             repository's working directory (tip).
@@ -507,18 +2370,64 @@ class Repo(object):
             If archive_type is not supplied mercurial will determine the
             type based on the file extension. If there is no file extension
             the default is "files".
+
+            include and exclude are lists of patterns (-I/-X) selecting
+            the files to archive, and prefix the directory prefix of the
+            files in the archive.
+        """
+        cmds = self.__archive_args(revision, archive_type, include, exclude,
+                                   prefix)
+        if hasattr(destination, "write"):
+            self.__check_stream_type(archive_type)
+            self.hg_command(*(cmds + ["-"]), timeout=timeout,
+                            stdout=destination)
+        else:
+            self.hg_command(*(cmds + [destination]), timeout=timeout)
+
+    ARCHIVE_STREAM_TYPES = ("tar", "tbz2", "tgz", "zip")
+
+    def hg_archive_stream(self, archive_type="tgz", revision=None,
+                          include=None, exclude=None, prefix=None,
+                          timeout=None, chunk_size=65536):
+        """
+            Archive a repository as a stream.
+
+            Returns a readable binary file object producing the archive
+            while hg creates it; see hg_archive for the arguments. Errors
+            are raised when the end of the stream is read. Closing the
+            stream early terminates hg.
         """
+        self.__check_stream_type(archive_type)
+        cmds = self.__archive_args(revision, archive_type, include, exclude,
+                                   prefix)
+        chunks = self.hg_command_iter(*(cmds + ["-"]), timeout=timeout,
+                                      chunk_size=chunk_size)
+        return io.BufferedReader(_IterStream(chunks))
+
+    def __check_stream_type(self, archive_type):
+        if archive_type not in self.ARCHIVE_STREAM_TYPES:
+            raise ValueError("Archive type %s cannot be streamed, use one "
+                             "of %s" % (archive_type,
+                                        ", ".join(self.ARCHIVE_STREAM_TYPES)))
+
+    def __archive_args(self, revision, archive_type, include, exclude,
+                       prefix):
         cmds = ['archive']
 
         if archive_type is not None:
             cmds.extend(('-t', archive_type))
 
         if revision is not None and revision != "tip":
-            cmds.extend(('-r', revision))
+            cmds.extend(('-r', str(revision)))
 
-        cmds.append(destination)
+        for option, patterns in (('-I', include), ('-X', exclude)):
+            for pattern in patterns or []:
+                cmds.extend((option, pattern))
 
-        self.hg_command(*cmds)
+        if prefix is not None:
+            cmds.extend(('-p', prefix))
+
+        return cmds
 
     rev_log_tpl = (
         '\{"node":"{node|short}","rev":"{rev}","author":"{author|urlescape}",'
@@ -532,9 +2441,17 @@ class Repo(object):
                           template=self.rev_log_tpl)
         return Revision(out)
 
-    def revisions(self, slice_):
-        """Returns a list of Revision objects for the given slice"""
+    def revisions(self, slice_, shards=1):
+        """
+            Returns a list of Revision objects for the given slice
+
+            With shards other than 1, the log is read from that many
+            concurrent hg processes (see map_shards) and the revisions
+            are returned in ascending revision order.
+        """
         id = ":".join([str(x) for x in (slice_.start, slice_.stop)])
+        if shards != 1:
+            return self.query(id, shards)
         out = self.hg_log(identifier=id,
                           template=self.rev_log_tpl)
 
@@ -544,6 +2461,74 @@ class Repo(object):
 
         return revs
 
+    def query(self, query, shards=1):
+        """
+            Returns a list of Revision objects for the changesets matching
+            query, a hgapi.Query or revset string, in the query's order.
+
+            With shards other than 1, the log is read from that many
+            concurrent hg processes (see map_shards) and the revisions
+            are returned in ascending revision order.
+        """
+        if shards != 1:
+            revs = [rev for shard in self.map_shards(self.query, query, shards)
+                    for rev in shard]
+            return sorted(revs, key=lambda rev: rev.rev)
+        out = self.hg_log(identifier=str(query), template=self.rev_log_tpl)
+        return [Revision(entry) for entry in out.split('\n')[:-1]]
+
+    def shard_revsets(self, revset="all()", shards=None):
+        """
+            Split revset into at most shards revsets, each restricted to
+            a range of consecutive revision numbers, in revision order.
+            shards defaults to the number of CPUs.
+        """
+        if shards is None:
+            shards = multiprocessing.cpu_count()
+        count = int(self.hg_log(identifier="tip", template="{rev}")) + 1
+        size = max(1, -(-count // max(shards, 1)))
+        return ["(%s) and %d:%d" % (revset, start,
+                                    min(start + size, count) - 1)
+                for start in range(0, count, size)]
+
+    def map_shards(self, func, revset="all()", shards=None):
+        """
+            Scan a large history from concurrent hg processes: call func
+            with each of the shard_revsets of revset, from one thread per
+            shard, and return the results in revision order. A shard
+            keeps the order of revset, which must not use limit().
+        """
+        revsets = self.shard_revsets(revset, shards)
+        return _map_concurrently(func, revsets, len(revsets))
+
+    def revisions_page(self, revset="all()", page_size=50, cursor=None):
+        """
+            Get one page of the revisions matching revset (a string or a
+            hgapi.Query), newest first.
+
+            cursor is None for the first page, or the cursor returned with
+            the previous page; a cursor that is not a node raises
+            ValueError. Returns a (revisions, next_cursor) tuple,
+            next_cursor being None on the last page. Each page costs a
+            single hg log bounded to page_size + 1 entries, and pages stay
+            stable while new changesets are added, since the cursor refers
+            to the last changeset seen rather than to an offset.
+        """
+        if cursor is None:
+            identifier = "sort(%s, -rev)" % revset
+        elif not re.match("^[0-9a-f]{12,40}$", cursor):
+            raise ValueError("Invalid revisions page cursor %r" % cursor)
+        else:
+            identifier = "sort((%s) and :%s - %s, -rev)" % (
+                revset, cursor, cursor)
+        out = self.hg_log(identifier=identifier, limit=page_size + 1,
+                          template=self.rev_log_tpl)
+        revs = [Revision(entry) for entry in out.split('\n')[:-1]]
+        if len(revs) <= page_size:
+            return revs, None
+        revs = revs[:page_size]
+        return revs, revs[-1].node
+
     def read_config(self):
         """
             Read the configuration as seen with 'hg showconfig'.
@@ -601,23 +2586,147 @@ class Repo(object):
             return value.split()
 
     @classmethod
-    def hg_version(cls):
-        """Return the version number of Mercurial."""
-        out = Repo.command(".", os.environ, "version")
-        match = re.search('\s\(version (.*)\)$', out.split("\n")[0])
-        return match.group(1)
+    def hg_version(cls, profile=None):
+        """
+            Return the version number of Mercurial, from the cached
+            capabilities, or by running hg version with profile if given.
+        """
+        if profile is None:
+            return cls.capabilities().version
+        out = cls.backend.run(".", profile.env,
+                              *(profile.args + ["version"]))
+        return Capabilities.parse_version(out)
+
+    _CLONE_OPTIONS = ("noupdate", "stream", "rev", "branch", "pull",
+                      "share", "profile", "timeout")
 
     @classmethod
-    def hg_clone(cls, url, path, *args):
+    def hg_clone(cls, url, path, *args, **kwargs):
         """
             Clone repository at given `url` to `path`, then return
             repo object to `path`.
+
+            Extra positional arguments are passed to hg clone. Keyword
+            arguments select the clone mode:
+
+            noupdate: do not check out a working copy (-U).
+            stream: stream the store files instead of recomputing them,
+            which is faster on fast networks.
+            rev: a revision or list of revisions; only their ancestors
+            are cloned.
+            branch: a branch or list of branches to clone.
+            pull: clone using the pull protocol instead of hardlinking
+            local store files.
+            share: create a working copy sharing the store of the local
+            repository at `url` (see hg_share) instead of copying it.
+
+            A profile keyword argument sets the execution Profile used
+            for the clone and by the returned Repo, and timeout the number
+            of seconds after which the clone is aborted.
+
+            Raise TypeError for unknown keyword arguments, and ValueError
+            when share is combined with options a share cannot honor.
+        """
+        unexpected = sorted(set(kwargs) - set(cls._CLONE_OPTIONS))
+        if unexpected:
+            raise TypeError("Unexpected arguments: %s"
+                            % ", ".join(unexpected))
+        if kwargs.get("share"):
+            conflicting = [name for name in ("stream", "pull", "rev",
+                                             "branch")
+                           if kwargs.get(name) not in (None, False)]
+            if args:
+                conflicting.append("extra arguments")
+            if conflicting:
+                raise ValueError("share cannot be combined with %s"
+                                 % ", ".join(conflicting))
+            return cls.hg_share(url, path, kwargs.get("noupdate", False),
+                                profile=kwargs.get("profile"),
+                                timeout=kwargs.get("timeout"))
+        options = []
+        if kwargs.get("noupdate"):
+            options.append("--noupdate")
+        if kwargs.get("stream"):
+            # --uncompressed is the name older versions know
+            capabilities = cls._probed()
+            stream = capabilities is None or \
+                capabilities.supports("clone", "stream")
+            options.append("--stream" if stream else "--uncompressed")
+        if kwargs.get("pull"):
+            options.append("--pull")
+        for option, name in (("--rev", "rev"), ("--branch", "branch")):
+            values = kwargs.get(name)
+            if values is None:
+                continue
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            for value in values:
+                options += [option, str(value)]
+        profile = kwargs.get("profile") or cls.profile
+        args = profile.args + ["clone", url, path] + options + list(args)
+        cls.backend.run(".", profile.env, *args,
+                        priority=PRIORITY_BACKGROUND,
+                        timeout=kwargs.get("timeout"))
+        return Repo(path, profile=kwargs.get("profile"))
+
+    @classmethod
+    def hg_clone_batch(cls, jobs, concurrency=4, progress=None, **kwargs):
+        """
+            Clone many repositories concurrently.
+
+            jobs is an iterable of (url, path) pairs, cloned by at most
+            concurrency threads at a time (the scheduler limits apply as
+            well). Keyword arguments are passed to hg_clone.
+
+            progress, if given, is called after each clone as
+            progress(url, path, result, done, total), where result is the
+            Repo or the HgException raised.
+
+            Returns a list with a Repo or HgException per job, in order.
+        """
+        jobs = list(jobs)
+        done = []
+
+        def clone(job):
+            url, path = job
+            try:
+                result = cls.hg_clone(url, path, **kwargs)
+            except HgException as ex:
+                result = ex
+            if progress is not None:
+                with lock:
+                    done.append(job)
+                    progress(url, path, result, len(done), len(jobs))
+            return result
+
+        lock = threading.Lock()
+        return _map_concurrently(clone, jobs, concurrency)
+
+    @classmethod
+    def hg_share(cls, source, path, noupdate=False, bookmarks=False,
+                 profile=None, timeout=None):
+        """
+            Create a working copy at `path` sharing the store of the
+            local repository at `source`, then return repo object to
+            `path`.
+
+            With noupdate set, no working copy is checked out. With
+            bookmarks set, bookmarks are shared as well. timeout is the
+            number of seconds after which the share is aborted.
         """
-        Repo.command(".", os.environ, "clone", url, path, *args)
-        return Repo(path)
+        repo_profile = profile
+        profile = (profile or cls.profile).extend(extensions=["share"])
+        args = ["share", os.path.abspath(source), path]
+        if noupdate:
+            args.append("--noupdate")
+        if bookmarks:
+            args.append("--bookmarks")
+        cls.backend.run(".", profile.env, *(profile.args + args),
+                        priority=PRIORITY_BACKGROUND, timeout=timeout)
+        return Repo(path, profile=repo_profile)
 
     @classmethod
-    def hg_root(self, path):
+    def hg_root(self, path, profile=None):
         """
             Return the root (top) of the path.
 
@@ -626,4 +2735,7 @@ class Repo(object):
         """
         if path is None:
             path = os.getcwd()
-        return Repo.command(path, os.environ, "root").strip("\n +")
+        profile = profile or Repo.profile
+        out = self.backend.run(path, profile.env,
+                               *(profile.args + ["root"]))
+        return out.strip("\n +")
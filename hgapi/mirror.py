@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+    Keep local mirrors of many repositories up to date by pulling from
+    them concurrently.
+
+    Can be run as a script::
+
+      python -m hgapi.mirror [--interval SECONDS] SOURCE PATH [SOURCE PATH...]
+"""
+from __future__ import print_function, unicode_literals, with_statement
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+from .hgapi import Repo, HgException, PRIORITY_BACKGROUND, _map_concurrently
+
+
+class MirrorResult(object):
+    """
+        Outcome of synchronizing one mirror.
+
+        new_nodes lists the full node ids of the changesets fetched,
+        skipped is True when the remote had not changed (or the mirror is
+        backing off after failures), and error holds the HgException of a
+        failed synchronization.
+    """
+
+    def __init__(self, source, path, new_nodes=None, skipped=False,
+                 error=None):
+        self.source = source
+        self.path = path
+        self.new_nodes = new_nodes or []
+        self.skipped = skipped
+        self.error = error
+
+    @property
+    def changed(self):
+        """True if new changesets were fetched."""
+        return bool(self.new_nodes)
+
+    def __repr__(self):
+        if self.error is not None:
+            state = "failed"
+        elif self.skipped:
+            state = "skipped"
+        else:
+            state = "%d new" % len(self.new_nodes)
+        return "<MirrorResult %s -> %s: %s>" % (self.source, self.path, state)
+
+
+class MirrorSync(object):
+    """
+        Synchronize local mirrors from their sources.
+
+        mirrors is an iterable of (source, path) pairs; a missing mirror
+        is cloned (without a working copy). Each sync() pulls up to
+        concurrency mirrors at a time.
+
+        Before pulling, the tip of the source is looked up with
+        'hg identify'; the pull is skipped when it is the same as after
+        the last synchronization. A mirror failing to synchronize is not
+        tried again for backoff seconds, doubled on each consecutive
+        failure up to max_backoff.
+    """
+
+    def __init__(self, mirrors, concurrency=4, backoff=60, max_backoff=3600,
+                 timeout=None, profile=None):
+        self.mirrors = list(mirrors)
+        self.concurrency = concurrency
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.profile = profile or Repo.profile
+        self._lock = threading.Lock()
+        self._remote_tips = {}
+        self._failures = {}
+        self._retry_at = {}
+
+    def _remote_tip(self, source):
+        """Return the node of the tip of source."""
+        args = self.profile.args + ["identify", "--id", "-r", "tip", source]
+        out = Repo.backend.run(".", self.profile.env, *args,
+                               priority=PRIORITY_BACKGROUND,
+                               timeout=self.timeout)
+        return out.strip()
+
+    def sync_one(self, source, path):
+        """Synchronize the mirror at path, returning a MirrorResult."""
+        remote = source
+        if os.path.isdir(source):
+            # relative local paths would be resolved from the mirror
+            remote = os.path.abspath(source)
+        with self._lock:
+            if self._retry_at.get(path, 0) > time.time():
+                return MirrorResult(source, path, skipped=True)
+        try:
+            remote_tip = self._remote_tip(remote)
+            if self._remote_tips.get(path) == remote_tip:
+                return MirrorResult(source, path, skipped=True)
+            if not os.path.exists(path):
+                repo = Repo.hg_clone(remote, path, noupdate=True,
+                                     profile=self.profile,
+                                     timeout=self.timeout)
+                before = -1
+            else:
+                repo = Repo(path, profile=self.profile)
+                before = int(repo.hg_log(identifier="tip",
+                                         template="{rev}"))
+                repo.hg_pull(remote, timeout=self.timeout)
+            revset = "all() - :%d" % before if before >= 0 else "all()"
+            new_nodes = repo.hg_log(identifier=revset,
+                                    template="{node}\\n").split()
+        except HgException as ex:
+            with self._lock:
+                failures = self._failures.get(path, 0) + 1
+                self._failures[path] = failures
+                delay = min(self.backoff * 2 ** (failures - 1),
+                            self.max_backoff)
+                self._retry_at[path] = time.time() + delay
+            return MirrorResult(source, path, error=ex)
+        with self._lock:
+            self._remote_tips[path] = remote_tip
+            self._failures.pop(path, None)
+            self._retry_at.pop(path, None)
+        return MirrorResult(source, path, new_nodes)
+
+    def sync(self):
+        """Synchronize all mirrors once, returning a list of MirrorResult."""
+        return _map_concurrently(lambda mirror: self.sync_one(*mirror),
+                                 self.mirrors, self.concurrency)
+
+    def run_forever(self, interval=300, stop=None, callback=None):
+        """
+            Synchronize all mirrors every interval seconds until the
+            threading.Event stop is set. callback, if given, is called
+            with the list of results after each round.
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            results = self.sync()
+            if callback is not None:
+                callback(results)
+            stop.wait(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m hgapi.mirror",
+        description="Synchronize local mirrors of Mercurial repositories.")
+    parser.add_argument("mirrors", nargs="+", metavar="SOURCE PATH",
+                        help="source and mirror path pairs")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--interval", type=float,
+                        help="keep synchronizing every INTERVAL seconds")
+    parser.add_argument("--timeout", type=float,
+                        help="abort a pull after TIMEOUT seconds")
+    args = parser.parse_args(argv)
+    if len(args.mirrors) % 2:
+        parser.error("mirrors must be given as SOURCE PATH pairs")
+    pairs = list(zip(args.mirrors[::2], args.mirrors[1::2]))
+    sync = MirrorSync(pairs, concurrency=args.concurrency,
+                      timeout=args.timeout)
+
+    def report(results):
+        for result in results:
+            if result.error is not None:
+                print("%s: failed: %s" % (result.path,
+                                          str(result.error).split("\n")[0]))
+            elif result.skipped:
+                print("%s: unchanged" % result.path)
+            else:
+                print("%s: %d new changesets" % (result.path,
+                                                 len(result.new_nodes)))
+        sys.stdout.flush()
+
+    if args.interval is None:
+        results = sync.sync()
+        report(results)
+        return 1 if any(r.error is not None for r in results) else 0
+    try:
+        sync.run_forever(args.interval, callback=report)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
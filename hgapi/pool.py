@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+    A pool of working copies sharing the store of one repository, for
+    checking out many revisions of it at the same time.
+"""
+from __future__ import print_function, unicode_literals, with_statement
+
+import os
+import shutil
+import threading
+import itertools
+from contextlib import contextmanager
+
+from .hgapi import Repo, HgException
+
+
+def _disk_usage(path):
+    """Return the size in bytes of the files below path."""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class WorkingCopyPool(object):
+    """
+        Hand out working copies of the repository at source, each
+        updated to a requested revision.
+
+        Working copies are created in root with 'hg share', so they share
+        the store of source and only cost the size of the checked out
+        files. A released copy is cleaned (local changes and untracked
+        files are removed) and kept for reuse; acquire() picks the idle
+        copy whose parent is closest to the requested revision to keep
+        the update cheap.
+
+        At most max_copies working copies exist at a time, acquire()
+        waits for one to be released when the limit is reached. When the
+        working copies use more than disk_budget bytes, idle copies are
+        deleted, least recently used first.
+
+        Example::
+
+          >>> pool = WorkingCopyPool("main-repo", "/tmp/checkouts")
+          >>> with pool.checkout("1.0") as repo:
+          ...     run_tests(repo.path)
+    """
+
+    def __init__(self, source, root, max_copies=None, disk_budget=None,
+                 profile=None):
+        self.source = Repo(source, profile=profile)
+        self.root = root
+        self.max_copies = max_copies
+        self.disk_budget = disk_budget
+        self.profile = profile
+        self._cond = threading.Condition()
+        self._idle = []
+        self._busy = set()
+        self._creating = set()
+        self._parents = {}
+        self._sizes = {}
+        self._counter = itertools.count()
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def _node(self, revision):
+        """Return the full node of revision."""
+        return self.source.hg_log(identifier=str(revision),
+                                  template="{node}").strip()
+
+    def _distances(self, node, parents):
+        """
+            Return the number of changesets separating node from each of
+            the parents nodes, computed with a single hg call.
+        """
+        if node in parents:
+            return dict((parent, 0 if parent == node else 1)
+                        for parent in parents)
+        template = ("{node} {revset('only(%%s, %%s) or only(%%s, %%s)', "
+                    "'%s', node, node, '%s')|count}\\n" % (node, node))
+        out = self.source.hg_log(identifier="+".join(sorted(parents)),
+                                 template=template)
+        return dict((parent, int(count)) for parent, count
+                    in (line.split() for line in out.splitlines()))
+
+    def _create(self, path):
+        repo = Repo.hg_share(self.source.path, path, noupdate=True,
+                             profile=self.profile)
+        self._parents[path] = "0" * 40
+        return repo
+
+    def _new_path(self):
+        while True:
+            path = os.path.join(self.root, "wc%d" % next(self._counter))
+            if not os.path.exists(path):
+                return path
+
+    def _reserve(self, node):
+        """
+            Take an idle working copy for node, or reserve the path of a
+            new one, waiting when max_copies is reached. Returns a (repo,
+            path) pair with one of them None. hg runs without holding the
+            lock, so other threads can acquire and release meanwhile.
+        """
+        while True:
+            with self._cond:
+                while True:
+                    candidates = dict(
+                        (repo.path, self._parents[repo.path])
+                        for repo in self._idle
+                        if self._parents[repo.path] != "0" * 40)
+                    if candidates:
+                        break
+                    if self._idle:
+                        repo = self._idle.pop()
+                        self._busy.add(repo)
+                        return repo, None
+                    total = (len(self._busy) + len(self._idle) +
+                             len(self._creating))
+                    if self.max_copies is None or total < self.max_copies:
+                        path = self._new_path()
+                        self._creating.add(path)
+                        return None, path
+                    self._cond.wait()
+            distances = self._distances(node, set(candidates.values()))
+            with self._cond:
+                # copies taken or updated meanwhile are not candidates
+                idle = [repo for repo in self._idle
+                        if candidates.get(repo.path) is not None and
+                        candidates[repo.path] == self._parents[repo.path]]
+                if idle:
+                    repo = min(idle, key=lambda r: distances[
+                        self._parents[r.path]])
+                    self._idle.remove(repo)
+                    self._busy.add(repo)
+                    return repo, None
+
+    def acquire(self, revision):
+        """Return a Repo for a working copy updated to revision."""
+        node = self._node(revision)
+        repo, path = self._reserve(node)
+        if repo is None:
+            try:
+                repo = self._create(path)
+            finally:
+                with self._cond:
+                    self._creating.discard(path)
+                    if repo is not None:
+                        self._busy.add(repo)
+                    self._cond.notify_all()
+        try:
+            if self._parents[repo.path] != node:
+                repo.hg_update(node, clean=True)
+                self._parents[repo.path] = node
+        except HgException:
+            self.release(repo)
+            raise
+        return repo
+
+    def release(self, repo):
+        """
+            Return a working copy to the pool, discarding local changes
+            and untracked files.
+        """
+        try:
+            # back to the recorded parent, the caller may have updated
+            repo.hg_update(self._parents[repo.path], clean=True)
+            repo.hg_command("--config", "extensions.purge=", "purge",
+                            "--all")
+        except HgException:
+            self._discard(repo)
+            raise
+        with self._cond:
+            self._busy.discard(repo)
+            self._idle.append(repo)
+            if self.disk_budget is not None:
+                self._sizes[repo.path] = _disk_usage(repo.path)
+                self._enforce_budget()
+            self._cond.notify_all()
+
+    def _enforce_budget(self):
+        while (self._idle and
+               sum(self._sizes.get(r.path, 0) for r in self._idle) +
+               sum(self._sizes.get(r.path, 0) for r in self._busy) >
+               self.disk_budget):
+            self._remove(self._idle.pop(0))
+
+    def _remove(self, repo):
+        self._parents.pop(repo.path, None)
+        self._sizes.pop(repo.path, None)
+        shutil.rmtree(repo.path, ignore_errors=True)
+
+    def _discard(self, repo):
+        with self._cond:
+            self._busy.discard(repo)
+            self._remove(repo)
+            self._cond.notify_all()
+
+    @contextmanager
+    def checkout(self, revision):
+        """Context manager acquiring and releasing a working copy."""
+        repo = self.acquire(revision)
+        try:
+            yield repo
+        finally:
+            self.release(repo)
+
+    def close(self):
+        """Delete all idle working copies."""
+        with self._cond:
+            while self._idle:
+                self._remove(self._idle.pop())
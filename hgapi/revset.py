@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+    A builder for revsets, the Mercurial language for selecting
+    changesets, so filtering is done by hg rather than on parsed logs.
+"""
+from __future__ import print_function, unicode_literals, with_statement
+
+import re
+
+SORT_KEYS = ("rev", "branch", "desc", "user", "author", "date", "node",
+             "topo")
+
+
+def quote(value):
+    """Quote value as a revset string literal."""
+    value = "%s" % value
+    return "'%s'" % value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def _literal(value):
+    """
+        Quote a string matched by hg as a pattern, so a value starting
+        with one of the pattern prefixes (re:, literal:) is matched as
+        is instead of being interpreted.
+    """
+    value = "%s" % value
+    if re.match("(re|literal):", value):
+        return quote("re:(?i)" + re.escape(value))
+    return quote(value)
+
+
+class Query(object):
+    """
+        A revset built from filters, all of which must match.
+
+        Every method returns a new Query, leaving the original unchanged,
+        and queries can be combined with & (both), | (either) and ~ (not).
+        The order and limit apply to the changesets matching all the
+        filters. str() gives the revset, with all values quoted, and a
+        Query can be used wherever hgapi takes a revset::
+
+          >>> query = Query().author("alice").merges(False).limit(10, "-date")
+          >>> str(query)
+          "limit(sort((author('alice')) and (not merge()), '-date'), 10)"
+          >>> revisions = repo.query(query)
+    """
+
+    def __init__(self, revset=None):
+        self._terms = () if revset is None else (revset,)
+        self._sort = None
+        self._limit = None
+
+    def _copy(self, terms=()):
+        query = Query()
+        query._terms = self._terms + terms
+        query._sort = self._sort
+        query._limit = self._limit
+        return query
+
+    def _with(self, term):
+        return self._copy((term,))
+
+    def revset(self, revset):
+        """Changesets in an arbitrary revset."""
+        return self._with(revset)
+
+    def author(self, name):
+        """Changesets whose author contains name, ignoring case."""
+        return self._with("author(%s)" % _literal(name))
+
+    def date(self, start=None, end=None):
+        """
+            Changesets committed between start and end, which take any
+            date format hg accepts (e.g. "2011-10-10" or "2011-10-10
+            12:00"). Either one can be None for an open range.
+        """
+        if start is None and end is None:
+            raise ValueError("date needs a start or an end")
+        if end is None:
+            spec = ">%s" % start
+        elif start is None:
+            spec = "<%s" % end
+        else:
+            spec = "%s to %s" % (start, end)
+        return self._with("date(%s)" % quote(spec))
+
+    def branch(self, name):
+        """Changesets on the named branch, none if it does not exist."""
+        # a literal name makes hg abort when the branch does not exist
+        pattern = "re:^%s$" % re.escape("%s" % name)
+        return self._with("branch(%s)" % quote(pattern))
+
+    def keyword(self, text):
+        """
+            Changesets whose message, author or changed file names contain
+            text, ignoring case.
+        """
+        return self._with("keyword(%s)" % quote(text))
+
+    def file(self, pattern):
+        """
+            Changesets touching files matching pattern, a file name or hg
+            pattern such as 'glob:src/**.py' or 'path:docs'.
+        """
+        return self._with("file(%s)" % quote(pattern))
+
+    def ancestors(self, rev):
+        """Changesets that are ancestors of rev, rev included."""
+        return self._with("ancestors(%s)" % quote(rev))
+
+    def descendants(self, rev):
+        """Changesets that are descendants of rev, rev included."""
+        return self._with("descendants(%s)" % quote(rev))
+
+    def merges(self, merges=True):
+        """Only merge changesets, or with merges False, no merges."""
+        return self._with("merge()" if merges else "not merge()")
+
+    def limit(self, count, order=None):
+        """
+            Keep the first count changesets, sorted by order first if
+            given (see order()).
+        """
+        query = self.order(order) if order is not None else self._copy()
+        query._limit = int(count)
+        return query
+
+    def order(self, key):
+        """
+            Sort by key, one of SORT_KEYS, prefixed with - for descending
+            order; a space separated list sorts by several keys.
+        """
+        for part in key.split():
+            if part.lstrip("-") not in SORT_KEYS:
+                raise ValueError("Unknown sort key %s" % part)
+        query = self._copy()
+        query._sort = key
+        return query
+
+    def _combine(self, other, operator):
+        return Query("(%s) %s (%s)" % (self, operator, other))
+
+    def __and__(self, other):
+        return self._combine(other, "and")
+
+    def __or__(self, other):
+        return self._combine(other, "or")
+
+    def __invert__(self):
+        return Query("not (%s)" % self)
+
+    def __str__(self):
+        if not self._terms:
+            revset = "all()"
+        elif len(self._terms) == 1:
+            revset = self._terms[0]
+        else:
+            revset = " and ".join("(%s)" % term for term in self._terms)
+        if self._sort:
+            revset = "sort(%s, %s)" % (revset, quote(self._sort))
+        if self._limit is not None:
+            revset = "limit(%s, %d)" % (revset, self._limit)
+        return revset
+
+    def __repr__(self):
+        return "Query(%r)" % str(self)
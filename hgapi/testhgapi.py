@@ -5,9 +5,19 @@ import unittest
 import doctest
 import os
 import shutil
-import hgapi
 import tempfile
 import sys
+import io
+import tarfile
+import zipfile
+import threading
+import time
+
+if __name__ == "__main__":
+    # run as a script, the directory of this file comes first on the path
+    # and hgapi would be the hgapi.py module instead of the package
+    sys.path[0] = os.path.dirname(os.path.abspath(sys.path[0]))
+import hgapi
 
 
 # TODO: add better logger test
@@ -37,11 +47,19 @@ class TestHgAPI(unittest.TestCase):
             setattr(cls, "assertNotEquals", cls.assertNotEqual)
         TestHgAPI._delete_and_create("./test")
         TestHgAPI._delete_and_create("./original")
+        # keep the probed capabilities out of the user's cache directory
+        cls._capabilities_cache = hgapi.Repo.capabilities_cache
+        cls._cache_directory = tempfile.mkdtemp()
+        hgapi.Repo.capabilities_cache = os.path.join(cls._cache_directory,
+                                                     "capabilities.json")
 
     @classmethod
     def tearDownClass(self):
+        hgapi.Repo.capabilities_cache = self._capabilities_cache
+        shutil.rmtree(self._cache_directory, ignore_errors=True)
         shutil.rmtree("test", ignore_errors=True)
         shutil.rmtree("test-clone", ignore_errors=True)
+        shutil.rmtree("test-pool", ignore_errors=True)
 
     def test_000_Init(self):
         self.repo.hg_init()
@@ -582,6 +600,837 @@ class TestHgAPI(unittest.TestCase):
         self.repo.hg_archive("test.tar.gz", revision="21")
         self.assertTrue(os.path.exists(os.path.join("test", "test.tar.gz")))
 
+    def test_600_Executable(self):
+        self.assertTrue(hgapi.Repo.probe_executable("hg"))
+        self.assertFalse(hgapi.Repo.probe_executable("no-such-hg"))
+        self.assertTrue(hgapi.Repo.detect_executable())
+        repo = hgapi.Repo("./test", executable="hg")
+        self.assertEquals(repo.hg_id(), self.repo.hg_id())
+        broken = hgapi.Repo("./test", executable="no-such-hg")
+        self.assertRaises(hgapi.HgException, broken.hg_id)
+
+    def test_610_Profile(self):
+        profile = hgapi.Repo.HERMETIC.extend(extensions=["share"],
+                                             config={"test.extra": "p"})
+        self.assertEquals(profile.env["HGPLAIN"], "1")
+        self.assertEquals(profile.env["HGRCPATH"], "")
+        self.assertEquals(profile.args, ["--config", "extensions.share=",
+                                         "--config", "test.extra=p"])
+        self.assertFalse("HGPLAIN" in hgapi.Repo.profile.env)
+        repo = hgapi.Repo("./test", profile=profile)
+        self.assertEquals(repo.hg_id(), self.repo.hg_id())
+        # the repository hgrc is still read
+        self.assertEquals(repo.config('ui', 'username'), "testsson")
+        self.assertEquals(repo.config('test', 'extra'), "p")
+        self.assertEquals(hgapi.Repo.hg_root("./test", profile=profile),
+                          hgapi.Repo.hg_root("./test"))
+        self.assertNotEquals(hgapi.Repo.hg_version(profile=profile), "")
+
+    def test_620_Scheduler(self):
+        scheduler = hgapi.Scheduler(max_processes=1)
+        order = []
+
+        def run(priority):
+            with scheduler.slot("./test", priority):
+                order.append(priority)
+
+        scheduler.acquire("./test")
+        threads = [threading.Thread(target=run, args=(priority,))
+                   for priority in (hgapi.Repo.PRIORITY_BACKGROUND,
+                                    hgapi.Repo.PRIORITY_INTERACTIVE)]
+        for thread in threads:
+            thread.start()
+            while scheduler.metrics()["waiting"] < threads.index(thread) + 1:
+                time.sleep(0.01)
+        scheduler.release("./test")
+        for thread in threads:
+            thread.join()
+        self.assertEquals(order, [hgapi.Repo.PRIORITY_INTERACTIVE,
+                                  hgapi.Repo.PRIORITY_BACKGROUND])
+        metrics = scheduler.metrics()
+        self.assertEquals(metrics["running"], 0)
+        self.assertEquals(
+            metrics["queue_time"][hgapi.Repo.PRIORITY_BACKGROUND]["count"], 1)
+
+        # per path limits do not block other paths
+        scheduler.configure(max_per_path=1)
+        scheduler.acquire("./test")
+        scheduler.acquire("./test-clone")
+        scheduler.release("./test")
+        scheduler.release("./test-clone")
+
+        # every command goes through the global scheduler
+        hgapi.Repo.scheduler.reset_metrics()
+        self.repo.hg_id()
+        queue_time = hgapi.Repo.scheduler.metrics()["queue_time"]
+        self.assertEquals(queue_time[hgapi.Repo.PRIORITY_NORMAL]["count"], 1)
+
+    def test_630_Timeout(self):
+        start = time.time()
+        self.assertRaises(hgapi.HgTimeoutException, self.repo.hg_command,
+                          "--config", "hooks.pre-log=sleep 10", "log",
+                          timeout=0.5)
+        with hgapi.deadline(0.5):
+            self.assertRaises(hgapi.HgTimeoutException, self.repo.hg_log,
+                              **{"--config": "hooks.pre-log=sleep 10"})
+        self.assertTrue(time.time() - start < 5)
+        # commands finishing in time are unaffected
+        self.assertEquals(self.repo.hg_id(), hgapi.Repo(
+            "./test", timeout=30).hg_id())
+
+    def test_640_Cancel(self):
+        token = hgapi.CancelToken()
+        lines = self.repo.hg_command_iter(
+            "--config", "hooks.pre-log=sleep 10", "log", cancel=token)
+        threading.Timer(0.5, token.cancel).start()
+        start = time.time()
+        self.assertRaises(hgapi.HgCancelledException, list, lines)
+        self.assertTrue(time.time() - start < 5)
+        # closing a stream early frees the process
+        lines = self.repo.hg_command_iter("log", "--template", "{rev}\n")
+        self.assertEquals(next(lines), "%d\n" % self.repo.hg_rev())
+        lines.close()
+        self.assertEquals(hgapi.Repo.scheduler.metrics()["running"], 0)
+
+    def test_650_LockContention(self):
+        wlock = os.path.join("test", ".hg", "wlock")
+        os.symlink("otherhost:1", wlock)
+        try:
+            repo = hgapi.Repo("./test", lock_timeout=1)
+            self.assertRaises(hgapi.HgLockException, repo.hg_bookmarks,
+                              action=repo.BOOKMARK_CREATE, name="locked")
+            # bulk commands merge errors into the output
+            with open(os.path.join("test", "locked.txt"), "w") as out:
+                out.write("locked")
+            self.assertRaises(hgapi.HgLockException, repo.hg_add,
+                              ["locked.txt"])
+            os.unlink(os.path.join("test", "locked.txt"))
+            # the lock is released while retrying
+            threading.Timer(1.5, os.unlink, (wlock,)).start()
+            repo = hgapi.Repo("./test", serialize_writes=True,
+                              lock_timeout=1, lock_retries=3,
+                              lock_backoff=0.1)
+            repo.hg_bookmarks(action=repo.BOOKMARK_CREATE, name="locked")
+        finally:
+            if os.path.lexists(wlock):
+                os.unlink(wlock)
+        self.assertTrue("locked" in [b[1] for b in self.repo.hg_bookmarks()])
+        self.repo.hg_bookmarks(action=self.repo.BOOKMARK_DELETE,
+                               name="locked")
+
+    def test_660_Share(self):
+        share = hgapi.Repo.hg_share("./test", "./test-pool/share")
+        self.assertEquals(share.hg_id(), self.repo.hg_id())
+        self.assertEquals(share.hg_node(), self.repo.hg_node())
+        shutil.rmtree("./test-pool")
+
+    def test_670_WorkingCopyPool(self):
+        pool = hgapi.WorkingCopyPool("./test", "./test-pool", max_copies=2)
+        first = pool.acquire(1)
+        second = pool.acquire(2)
+        self.assertNotEquals(first.path, second.path)
+        self.assertEquals(first.hg_rev(), 1)
+        self.assertEquals(second.hg_rev(), 2)
+        with open(os.path.join(second.path, "junk.txt"), "w") as out:
+            out.write("junk")
+        pool.release(first)
+        pool.release(second)
+        # the copy closest to the requested revision is reused and clean
+        with pool.checkout(2) as repo:
+            self.assertEquals(repo.path, second.path)
+            self.assertEquals(repo.hg_status(empty=True), {})
+            repo.hg_update(0)
+        # updates made by the caller are undone on release
+        with pool.checkout(2) as repo:
+            self.assertEquals(repo.path, second.path)
+            self.assertEquals(repo.hg_rev(), 2)
+        with pool.checkout(0) as repo:
+            self.assertEquals(repo.path, first.path)
+            self.assertEquals(repo.hg_rev(), 0)
+        # idle copies are evicted when over the disk budget
+        pool.disk_budget = 0
+        with pool.checkout("tip") as repo:
+            path = repo.path
+        self.assertFalse(os.path.exists(path))
+        pool.close()
+        self.assertEquals(os.listdir("./test-pool"), [])
+        shutil.rmtree("./test-pool")
+
+    def test_680_CloneModes(self):
+        clone = hgapi.Repo.hg_clone("./test", "./test-pool/noupdate",
+                                    noupdate=True, stream=True)
+        self.assertEquals(clone.hg_id(), "000000000000")
+        clone = hgapi.Repo.hg_clone("./test", "./test-pool/rev", rev=1,
+                                    pull=True)
+        self.assertEquals(clone.hg_rev(), 1)
+        self.assertEquals(len(clone[0:'tip']), 2)
+        clone = hgapi.Repo.hg_clone("./test", "./test-pool/share",
+                                    share=True)
+        self.assertEquals(clone.hg_node(), self.repo.hg_node())
+        self.assertRaises(TypeError, hgapi.Repo.hg_clone, "./test",
+                          "./test-pool/typo", no_update=True)
+        self.assertRaises(ValueError, hgapi.Repo.hg_clone, "./test",
+                          "./test-pool/conflict", share=True, rev=1)
+        self.assertFalse(os.path.exists("./test-pool/typo"))
+        self.assertFalse(os.path.exists("./test-pool/conflict"))
+        shutil.rmtree("./test-pool")
+
+    def test_690_CloneBatch(self):
+        reports = []
+        jobs = [("./test", "./test-pool/%d" % i) for i in range(3)]
+        jobs.append(("./whatever", "./test-pool/missing"))
+        results = hgapi.Repo.hg_clone_batch(
+            jobs, concurrency=2, noupdate=True,
+            progress=lambda *args: reports.append(args))
+        self.assertEquals([r.path for r in results[:3]],
+                          [path for url, path in jobs[:3]])
+        self.assertTrue(isinstance(results[3], hgapi.HgException))
+        self.assertEquals(sorted(r[3] for r in reports), [1, 2, 3, 4])
+        shutil.rmtree("./test-pool")
+
+    def test_700_MirrorSync(self):
+        upstream = hgapi.Repo("./test-pool/upstream", user="test")
+        os.makedirs(upstream.path)
+        upstream.hg_init()
+        with open("./test-pool/upstream/a.txt", "w") as out:
+            out.write("a")
+        upstream.hg_add("a.txt")
+        upstream.hg_commit("first")
+        sync = hgapi.MirrorSync([(upstream.path, "./test-pool/mirror"),
+                                 ("./whatever", "./test-pool/broken")],
+                                backoff=60)
+        first, broken = sync.sync()
+        self.assertEquals(first.new_nodes, [upstream.hg_node()])
+        self.assertTrue(broken.error is not None)
+        # unchanged remotes and failing mirrors backing off are skipped
+        first, broken = sync.sync()
+        self.assertTrue(first.skipped)
+        self.assertFalse(first.changed)
+        self.assertTrue(broken.skipped)
+        upstream.hg_commit("second", close_branch=True)
+        first, broken = sync.sync()
+        self.assertEquals(first.new_nodes, [upstream.hg_node()])
+        self.assertEquals(hgapi.Repo("./test-pool/mirror")["tip"].desc,
+                          "second")
+        # one-shot command line
+        from hgapi import mirror
+        self.assertEquals(mirror.main([upstream.path,
+                                       "./test-pool/mirror"]), 0)
+        shutil.rmtree("./test-pool")
+
+    def test_710_IncomingBundle(self):
+        upstream = hgapi.Repo("./test-pool/upstream", user="test")
+        os.makedirs(upstream.path)
+        upstream.hg_init()
+        with open("./test-pool/upstream/a.txt", "w") as out:
+            out.write("a")
+        upstream.hg_add("a.txt")
+        upstream.hg_commit("first")
+        clone = hgapi.Repo.hg_clone(upstream.path, "./test-pool/clone")
+        upstream.hg_commit("second", close_branch=True)
+        upstream.hg_bookmarks(action=upstream.BOOKMARK_CREATE,
+                              name="feature")
+        incoming = clone.hg_incoming(bundle=True)
+        self.assertEquals([rev.desc for rev in incoming], ["second"])
+        # the pull applies the saved bundle, then syncs phases and
+        # bookmarks without transferring the changeset again
+        clone.hg_pull()
+        self.assertEquals(clone["tip"].desc, "second")
+        self.assertEquals(clone.hg_log(identifier="tip",
+                                       template="{phase} {bookmarks}"),
+                          "public feature")
+        self.assertEquals(clone.hg_incoming(bundle=True), [])
+        clone.hg_pull()
+        with open("./test-pool/upstream/b.txt", "w") as out:
+            out.write("b")
+        upstream.hg_add("b.txt")
+        upstream.hg_commit("third")
+        self.assertEquals(len(clone.hg_incoming(bundle=True)), 1)
+        bundle = clone._bundles["default"][0]
+        self.assertTrue(os.path.exists(bundle))
+        clone.discard_bundles()
+        self.assertFalse(os.path.exists(os.path.dirname(bundle)))
+        clone.hg_pull()
+        self.assertEquals(clone["tip"].desc, "third")
+        shutil.rmtree("./test-pool")
+
+    def test_720_Bundle(self):
+        stream = io.BytesIO()
+        count = self.repo.hg_bundle(stream, all=True, compression="none")
+        self.assertEquals(count, len(self.repo[0:'tip']))
+        self.assertTrue(stream.getvalue().startswith(b"HG20"))
+        self.assertEquals(self.repo.hg_bundle(stream, base="tip",
+                                              revs="tip"), 0)
+        self.assertRaises(ValueError, self.repo.hg_bundle, "x.hg", all=True,
+                          compression="lzma")
+        # hg failing before it opens the pipe
+        self.assertRaises(hgapi.HgException, self.repo.hg_bundle,
+                          io.BytesIO(), revs="no-such-revision")
+        bundle = os.path.abspath("./test-pool.hg")
+        self.assertEquals(self.repo.hg_bundle(bundle, base=0,
+                                              compression="gzip"),
+                          count - 1)
+        try:
+            for source in (io.BytesIO(stream.getvalue()), open(bundle, "rb")):
+                target = hgapi.Repo("./test-pool")
+                os.makedirs(target.path)
+                target.hg_init()
+                if isinstance(source, io.BytesIO):
+                    self.assertEquals(target.hg_unbundle(source), count)
+                else:
+                    # a partial bundle needs its base revision
+                    target.hg_command("pull", "-r", "0",
+                                      os.path.abspath("./test"))
+                    self.assertEquals(target.hg_unbundle(source), count - 1)
+                source.close()
+                self.assertEquals(target["tip"].node, self.repo["tip"].node)
+                shutil.rmtree("./test-pool")
+            target = hgapi.Repo.hg_clone("./test", "./test-pool", rev=0)
+            self.assertEquals(target.hg_unbundle(bundle, update=True),
+                              count - 1)
+            self.assertEquals(target.hg_id(), self.repo["tip"].node)
+            shutil.rmtree("./test-pool")
+
+            # a stream that cannot be rewound is spooled for retries
+            class Stream(object):
+                def __init__(self, data):
+                    self.data = io.BytesIO(data)
+
+                def read(self, size=-1):
+                    return self.data.read(size)
+            target = hgapi.Repo("./test-pool", lock_timeout=1,
+                                lock_retries=3, lock_backoff=0.1)
+            os.makedirs(target.path)
+            target.hg_init()
+            lock = os.path.join(target.path, ".hg", "store", "lock")
+            os.symlink("otherhost:1", lock)
+            threading.Timer(1.5, os.unlink, (lock,)).start()
+            self.assertEquals(target.hg_unbundle(Stream(stream.getvalue())),
+                              count)
+            self.assertEquals(target["tip"].node, self.repo["tip"].node)
+        finally:
+            os.unlink(bundle)
+        shutil.rmtree("./test-pool")
+
+    def test_730_ArchiveStream(self):
+        output = io.BytesIO()
+        self.repo.hg_archive(output, archive_type="zip", prefix="root",
+                             include=["cities/*"], exclude=["**/ghent.txt"])
+        names = zipfile.ZipFile(io.BytesIO(output.getvalue())).namelist()
+        self.assertEquals(sorted(names), ["root/cities/antwerp.txt",
+                                          "root/cities/brussels.txt"])
+        with tempfile.TemporaryFile() as output:
+            self.repo.hg_archive(output, revision=21, archive_type="tar",
+                                 prefix="root")
+            output.seek(0)
+            names = tarfile.open(fileobj=output).getnames()
+            self.assertTrue("root/cities/antwerp.txt" in names)
+            self.assertFalse("root/cities/ghent.txt" in names)
+        stream = self.repo.hg_archive_stream("tgz", prefix="root",
+                                             include=["bar.txt"])
+        archive = tarfile.open(fileobj=stream, mode="r|gz")
+        self.assertEquals([member.name for member in archive],
+                          ["root/bar.txt"])
+        stream.close()
+        self.assertRaises(ValueError, self.repo.hg_archive, io.BytesIO())
+        self.assertRaises(ValueError, self.repo.hg_archive_stream, "files")
+
+    def test_740_BulkMutations(self):
+        os.makedirs("./test/bulk")
+        names = ["bulk/file%03d.txt" % i for i in range(120)]
+        for name in names:
+            with open(os.path.join("test", name), "w") as out:
+                out.write(name)
+        repo = hgapi.Repo("./test")
+        repo.max_arg_length = 1000
+        added = repo.hg_add(names + ["bulk/missing.txt"])
+        self.assertEquals(len(added), 121)
+        self.assertTrue(all(added[name] for name in names))
+        self.assertFalse(added["bulk/missing.txt"])
+        self.assertEquals(len(repo.hg_status()["A"]), 120)
+        # already tracked files are reported as not added
+        self.assertEquals(repo.hg_add(names[:2]),
+                          {names[0]: False, names[1]: False})
+        repo.hg_commit("bulk", user="test")
+        os.makedirs("./test/moved")
+        moved = repo.hg_move(names[:50], "moved")
+        self.assertTrue(all(moved.values()))
+        self.assertEquals(len(moved), 50)
+        repo.hg_commit("bulk move", user="test")
+        removed = repo.hg_remove(["moved/" + os.path.basename(name)
+                                  for name in names[:50]])
+        self.assertTrue(all(removed.values()))
+        self.assertEquals(len(removed), 50)
+        self.assertEquals(repo.hg_remove(["bulk/untracked.txt"]),
+                          {"bulk/untracked.txt": False})
+        os.unlink(os.path.join("test", names[50]))
+        result = repo.hg_addremove([names[50], names[51]])
+        self.assertEquals(result, {names[50]: True, names[51]: False})
+        self.assertEquals(repo.hg_remove(names[52:]),
+                          dict((name, True) for name in names[52:]))
+        repo.hg_commit("bulk removal", user="test")
+        self.assertEquals(os.listdir("./test/bulk"), ["file051.txt"])
+        # paths starting with a dash are not taken for options
+        with open("./test/-dash.txt", "w") as out:
+            out.write("dash")
+        self.assertEquals(repo.hg_add(["-dash.txt"]), {"-dash.txt": True})
+        repo.hg_commit("dash", user="test")
+        self.assertEquals(repo.hg_move(["-dash.txt"], "-moved.txt"),
+                          {"-dash.txt": True})
+        repo.hg_commit("dash move", user="test")
+        self.assertEquals(repo.hg_remove(["-moved.txt"]),
+                          {"-moved.txt": True})
+        repo.hg_commit("dash removal", user="test")
+
+    def test_750_CommitPipeline(self):
+        repo = self.repo
+        changes = [
+            ({"pipe/a.txt": "one\n", "pipe/b.dat": b"\0\1\2" * 10},
+             "pipe first", "importer", "2011-10-10 12:00 +0000"),
+            ({"pipe/a.txt": "one\ntwo", "pipe/b.dat": None},
+             "pipe second\n\nbody", None, None),
+            ({"pipe/c.txt": "three\n"}, "pipe third", "other", None)]
+        nodes = repo.hg_commit_pipeline(changes, batch_size=2)
+        self.assertEquals(len(nodes), 3)
+        self.assertEquals(repo.hg_node(), nodes[-1])
+        first, second, third = [repo[node] for node in nodes]
+        self.assertEquals(first.author, "importer")
+        self.assertEquals(first.date, "2011-10-10 12:00 +0000")
+        self.assertEquals(second.author, "testuser")
+        self.assertEquals(second.desc, "pipe second\n\nbody")
+        self.assertEquals(third.parents, [second.rev])
+        self.assertEquals(repo.hg_command("cat", "-r", nodes[0],
+                                          "pipe/b.dat"), "\0\1\2" * 10)
+        self.assertEquals(open("./test/pipe/a.txt").read(), "one\ntwo")
+        self.assertFalse(os.path.exists("./test/pipe/b.dat"))
+        status = repo.hg_status()
+        self.assertEquals(status["M"] + status["A"] + status["R"], [])
+        # nothing is committed for invalid changes
+        self.assertRaises(ValueError, repo.hg_commit_pipeline,
+                          [({}, "empty", None, None)])
+        self.assertRaises(ValueError, repo.hg_commit_pipeline,
+                          [({"pipe/b.dat": None}, "untracked", None, None)])
+        self.assertRaises(hgapi.HgException, repo.hg_commit_pipeline,
+                          [({"pipe/c.txt": "three\n"}, "same", None, None)])
+        self.assertEquals(repo.hg_node(), nodes[-1])
+
+    def test_755_CommitPipelineLocked(self):
+        directory = tempfile.mkdtemp()
+        try:
+            repo = hgapi.Repo(directory, user="testuser", lock_timeout=1,
+                              lock_retries=3, lock_backoff=0.1)
+            repo.hg_init()
+            wlock = os.path.join(directory, ".hg", "wlock")
+            os.symlink("otherhost:1", wlock)
+            # the patches are fed again after each failed attempt
+            threading.Timer(1.5, os.unlink, (wlock,)).start()
+            changes = [({"f%d.txt" % i: "%d\n" % i}, "change %d" % i, None,
+                        None) for i in range(6)]
+            nodes = repo.hg_commit_pipeline(changes)
+            self.assertEquals(len(nodes), 6)
+            self.assertEquals(repo.hg_log(identifier="tip",
+                                          template="{desc}"), "change 5")
+
+            # a stream that cannot be rewound is not retried
+            class Stream(object):
+                def __init__(self, data):
+                    self.data = io.BytesIO(data)
+
+                def read(self, size=-1):
+                    return self.data.read(size)
+            patch = hgapi.hgapi._changeset_patch({"g.txt": "g"}, "g",
+                                                 tracked=set())
+            os.symlink("otherhost:1", wlock)
+            try:
+                self.assertRaises(hgapi.HgLockException, repo.hg_import,
+                                  Stream(patch))
+            finally:
+                os.unlink(wlock)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_760_RevisionsPage(self):
+        expected = [rev.node for rev in reversed(self.repo[0:'tip'])]
+        nodes, cursor, pages = [], None, 0
+        while True:
+            page, cursor = self.repo.revisions_page(page_size=4,
+                                                    cursor=cursor)
+            self.assertTrue(len(page) <= 4)
+            nodes += [rev.node for rev in page]
+            pages += 1
+            if cursor is None:
+                break
+            if pages == 1:
+                # new changesets don't shift the following pages
+                self.repo.hg_commit_pipeline(
+                    [({"page.txt": "page"}, "after first page", None, None)])
+        self.assertEquals(nodes, expected)
+        page, cursor = self.repo.revisions_page("author(importer)")
+        self.assertEquals([rev.desc for rev in page], ["pipe first"])
+        self.assertEquals(cursor, None)
+        self.assertRaises(ValueError, self.repo.revisions_page,
+                          cursor="tip) or all() or (tip")
+
+    def test_770_LazySlicing(self):
+        repo = hgapi.Repo("./test")
+        calls = []
+        hg_command = repo.hg_command
+
+        def counting(*args, **kwargs):
+            calls.append(args)
+            return hg_command(*args, **kwargs)
+        repo.hg_command = counting
+        revs = repo[0:'tip']
+        self.assertEquals(calls, [])
+        tip = repo['tip'].rev
+        self.assertEquals(len(revs), tip + 1)
+        self.assertEquals(len(calls), 2)
+        revs.page_size = 5
+        self.assertEquals(revs[-1].rev, tip)
+        self.assertEquals(revs[6].rev, 6)
+        self.assertEquals(revs[7].rev, 7)
+        self.assertEquals(len(calls), 4)
+        self.assertEquals([rev.rev for rev in revs], list(range(tip + 1)))
+        self.assertEquals(revs, repo.revisions(slice(0, 'tip')))
+        self.assertEquals(list(revs[2:5]), [revs[2], revs[3], revs[4]])
+        stepped = repo[0:'tip':3]
+        self.assertEquals([rev.rev for rev in stepped],
+                          list(range(0, tip + 1, 3)))
+        self.assertEquals([rev.rev for rev in repo['tip':2]],
+                          list(range(tip, 1, -1)))
+        self.assertEquals([rev.rev for rev in revs[::-4]],
+                          list(range(tip, -1, -4)))
+        self.assertRaises(IndexError, lambda: revs[tip + 1])
+        # hidden changesets leave gaps in the revision numbers
+        directory = tempfile.mkdtemp()
+        try:
+            profile = hgapi.Repo.HERMETIC.extend(
+                config={"experimental.evolution": "all"})
+            evolved = hgapi.Repo(directory, user="testuser", profile=profile)
+            evolved.hg_init()
+            for name in ("a.txt", "b.txt"):
+                with open(os.path.join(directory, name), "w") as out:
+                    out.write(name)
+                evolved.hg_add(name)
+                evolved.hg_commit(name)
+            evolved.hg_commit("amended", amend=True)
+            revs = evolved[0:'tip']
+            self.assertEquals(len(revs), 2)
+            self.assertEquals([rev.rev for rev in revs], [0, 2])
+            self.assertEquals(revs[len(revs) - 1].desc, "amended")
+        finally:
+            shutil.rmtree(directory)
+
+    def test_780_Query(self):
+        query = hgapi.Query()
+
+        def descs(query):
+            return [rev.desc for rev in self.repo.query(query)]
+        self.assertEquals(descs(query.author("IMPORTER")), ["pipe first"])
+        self.assertEquals(descs(query.author("},desc=\"test")), ["}"])
+        self.assertEquals(descs(query.date("2011-10-10 06:00",
+                                           "2011-10-10 18:00")),
+                          ["pipe first"])
+        self.assertEquals(len(self.repo.query(query.date(end="2011-10-11"))),
+                          3)
+        self.assertEquals(descs(query.file("pipe/c.txt")), ["pipe third"])
+        pipe = query.keyword("pipe").merges(False)
+        self.assertEquals(descs(pipe.limit(2, "-rev")),
+                          ["pipe third", "pipe second\n\nbody"])
+        self.assertEquals(descs(pipe & query.author("other")), ["pipe third"])
+        self.assertEquals(len(self.repo.query(pipe | query.author("other"))),
+                          3)
+        second = self.repo.query(pipe.limit(1, "-rev").order("rev"))
+        self.assertEquals(second[0].desc, "pipe first")
+        self.assertEquals(descs(pipe.descendants(second[0].node) &
+                                ~query.author("importer")),
+                          ["pipe second\n\nbody", "pipe third"])
+        self.assertEquals(descs(query.branch("test-branch")), [])
+        self.assertEquals(descs(query.keyword("no such 'thing'")), [])
+        self.assertRaises(ValueError, query.order, "size")
+
+    def test_790_HistoryColumns(self):
+        columns = hgapi.HistoryColumns.from_repo(self.repo, files=True)
+        revisions = self.repo.revisions(slice(0, 'tip'))
+        self.assertEquals(len(columns), len(revisions))
+        self.assertEquals(list(columns.rev), list(range(len(revisions))))
+        for index, revision in enumerate(revisions):
+            self.assertTrue(columns.hex(index).startswith(revision.node))
+            self.assertEquals(columns.authors[columns.author[index]],
+                              revision.author)
+            self.assertEquals(columns.branch_names[columns.branch[index]],
+                              revision.branch)
+            self.assertEquals(columns.p1[index], revision.parents[0])
+        self.assertEquals(columns.branch_names[0], "default")
+        self.assertEquals(columns.p2[0], -1)
+        self.assertEquals(columns.timestamp[0] > 0, True)
+        pipe = hgapi.HistoryColumns.from_repo(
+            self.repo, hgapi.Query().keyword("pipe"))
+        self.assertEquals(pipe.files, None)
+        self.assertEquals(pipe.authors, ["importer", "testuser", "other"])
+        self.assertEquals(list(pipe.author), [0, 1, 2])
+        self.assertEquals(pipe.timestamp[0], 1318248000.0)
+        self.assertEquals(list(pipe.tzoffset), [0, 0, 0])
+        files = hgapi.HistoryColumns.from_repo(self.repo, "author(importer)",
+                                               files=True)
+        self.assertEquals(list(files.files), [2])
+
+    def test_800_Churn(self):
+        Stats = hgapi.ChurnStats
+        pipe = hgapi.Query().keyword("pipe")
+        churn = hgapi.Churn.from_repo(self.repo, pipe)
+        self.assertEquals(churn.changesets, 3)
+        self.assertEquals(churn.files, {"pipe/a.txt": Stats(2, 2, 0),
+                                        "pipe/b.dat": Stats(2, 0, 0),
+                                        "pipe/c.txt": Stats(1, 1, 0)})
+        self.assertEquals(churn.authors, {"importer": Stats(1, 1, 0),
+                                          "testuser": Stats(1, 1, 0),
+                                          "other": Stats(1, 1, 0)})
+        self.assertEquals(churn.hotspots(2),
+                          [("pipe/a.txt", Stats(2, 2, 0)),
+                           ("pipe/b.dat", Stats(2, 0, 0))])
+        self.assertEquals(churn.hotspots(1, "lines"),
+                          [("pipe/a.txt", Stats(2, 2, 0))])
+        text = hgapi.Churn.from_repo(self.repo, pipe,
+                                     include=["glob:**.txt"],
+                                     exclude=["pipe/c.txt"])
+        self.assertEquals(text.changesets, 2)
+        self.assertEquals(list(text.files), ["pipe/a.txt"])
+        text.update(churn)
+        self.assertEquals(text.changesets, 5)
+        self.assertEquals(text.files["pipe/a.txt"], Stats(4, 4, 0))
+
+    def test_810_Shards(self):
+        count = len(self.repo[0:'tip'])
+        revsets = self.repo.shard_revsets("all()", 3)
+        self.assertEquals(len(revsets), 3)
+        self.assertEquals(sum(len(self.repo.query(revset))
+                              for revset in revsets), count)
+        self.assertEquals(len(self.repo.shard_revsets(shards=count * 2)),
+                          count)
+        self.assertEquals(self.repo.revisions(slice(0, 'tip'), shards=3),
+                          self.repo.revisions(slice(0, 'tip')))
+        self.assertEquals(self.repo.query("2 or merge()", shards=4),
+                          self.repo.query("2 or merge()"))
+        columns = hgapi.HistoryColumns.from_repo(self.repo, files=True)
+        sharded = hgapi.HistoryColumns.from_repo(self.repo, files=True,
+                                                 shards=None)
+        for name in columns.COLUMNS:
+            self.assertEquals(getattr(sharded, name), getattr(columns, name))
+        churn = hgapi.Churn.from_repo(self.repo)
+        sharded = hgapi.Churn.from_repo(self.repo, shards=3)
+        self.assertEquals(sharded.changesets, churn.changesets)
+        self.assertEquals(sharded.files, churn.files)
+        self.assertEquals(sharded.authors, churn.authors)
+
+    def test_820_Grep(self):
+        pipe = self.repo.query(hgapi.Query().keyword("pipe"))
+        matches = list(self.repo.hg_grep("^t.o$",
+                                         hgapi.Query().keyword("pipe")))
+        self.assertEquals(matches, [(pipe[1].rev, "pipe/a.txt", 2, "two"),
+                                    (pipe[2].rev, "pipe/a.txt", 2, "two")])
+        self.assertEquals(list(self.repo.hg_grep("TWO", pipe[1].node,
+                                                 ignore_case=True,
+                                                 include=["pipe/*.txt"])),
+                          [(pipe[1].rev, "pipe/a.txt", 2, "two")])
+        self.assertEquals(list(self.repo.hg_grep("two", exclude=["pipe"])),
+                          [])
+        self.assertEquals(list(self.repo.hg_grep("^two$")),
+                          [(None, "pipe/a.txt", 2, "two")])
+        self.assertEquals(list(self.repo.hg_grep("e", "all()", shards=3)),
+                          list(self.repo.hg_grep("e", "all()")))
+        search = self.repo.hg_grep(".", "all()", shards=2)
+        self.assertEquals(next(search)[0], 0)
+        search.close()
+
+    def test_830_Annotate(self):
+        pipe = self.repo.query(hgapi.Query().keyword("pipe"))
+        third = self.repo.hg_log(identifier=pipe[2].node,
+                                 template="{node}")
+        hgapi.Repo.annotate_cache.clear()
+        lines = self.repo.hg_annotate("pipe/a.txt", pipe[2].node)
+        self.assertEquals([(line.rev, line.line_number, line.line)
+                           for line in lines],
+                          [(pipe[0].rev, 1, "one\n"),
+                           (pipe[1].rev, 2, "two")])
+        self.assertEquals(lines[0].author, "importer")
+        self.assertEquals(lines[0].date, (1318248000, 0))
+        self.assertEquals(len(hgapi.Repo.annotate_cache), 1)
+        calls = []
+        repo = hgapi.Repo("./test")
+        hg_command = repo.hg_command
+
+        def counting(*args, **kwargs):
+            calls.append(args[0])
+            return hg_command(*args, **kwargs)
+        repo.hg_command = counting
+        files = repo.hg_annotate(["pipe/a.txt", "./pipe/c.txt"], third)
+        self.assertEquals(calls, ["annotate"])
+        self.assertEquals(files["pipe/a.txt"], lines)
+        self.assertEquals(files["pipe/c.txt"][0].author, "other")
+        self.assertEquals(repo.hg_annotate("pipe/c.txt", third),
+                          files["pipe/c.txt"])
+        self.assertEquals(calls, ["annotate"])
+        self.assertEquals(self.repo.hg_annotate("pipe/b.dat", pipe[0].node),
+                          [])
+        hgapi.Repo.annotate_cache.maxsize = 2
+        self.repo.hg_annotate("pipe/a.txt", pipe[1].node)
+        self.assertEquals(len(hgapi.Repo.annotate_cache), 2)
+        hgapi.Repo.annotate_cache.maxsize = 1000
+
+    def test_840_ParallelBisect(self):
+        third = self.repo.query(hgapi.Query().keyword("pipe"))[2]
+        revisions = []
+
+        def test(repo):
+            revisions.append(repo.hg_rev())
+            return not os.path.exists(os.path.join(repo.path, "pipe",
+                                                   "c.txt"))
+        pool = hgapi.WorkingCopyPool("./test", "./test-pool", max_copies=3)
+        result = hgapi.parallel_bisect("./test", 0, "tip", test, probes=3,
+                                       pool=pool)
+        self.assertTrue(result.first_bad.startswith(third.node))
+        self.assertEquals(result.candidates, [result.first_bad])
+        self.assertEquals(len(result.results), len(revisions))
+        self.assertTrue(len(revisions) < len(self.repo[0:'tip']) // 2)
+
+        def skipping(repo):
+            if repo.hg_rev() == third.rev:
+                return None
+            return test(repo)
+        result = hgapi.parallel_bisect("./test", 0, "tip", skipping,
+                                       probes=2, pool=pool)
+        self.assertEquals(result.first_bad, None)
+        self.assertTrue(len(result.candidates) > 1)
+        self.assertTrue(result.candidates[0].startswith(third.node))
+        pool.close()
+        shutil.rmtree("./test-pool")
+
+    def test_850_Fingerprint(self):
+        fingerprint = self.repo.fingerprint()
+        self.assertEquals(self.repo.fingerprint(), fingerprint)
+        self.assertEquals(hgapi.Repo("./test").fingerprint(), fingerprint)
+        watcher = hgapi.RepoWatcher("./test", interval=0.05)
+        self.assertEquals(watcher.poll(), None)
+        events = []
+        changed = threading.Event()
+
+        def notify(repo, nodes):
+            events.append(nodes)
+            changed.set()
+        watcher.subscribe(notify)
+        watcher.start()
+        try:
+            nodes = self.repo.hg_commit_pipeline(
+                [({"watch.txt": "watched"}, "watched", None, None)])
+            self.assertTrue(changed.wait(10))
+        finally:
+            watcher.stop()
+        watcher.poll()
+        self.assertNotEquals(self.repo.fingerprint(), fingerprint)
+        self.assertEquals(sum(events, []), nodes)
+        del events[:]
+        fingerprint = self.repo.fingerprint()
+        self.repo.hg_bookmarks(action=self.repo.BOOKMARK_CREATE,
+                               name="watched")
+        self.assertNotEquals(self.repo.fingerprint(), fingerprint)
+        self.assertEquals(watcher.poll(), [])
+        self.assertEquals(events, [[]])
+        watcher.unsubscribe(notify)
+        self.repo.hg_bookmarks(action=self.repo.BOOKMARK_DELETE,
+                               name="watched")
+        self.assertEquals(watcher.poll(), [])
+        self.assertEquals(watcher.poll(), None)
+        self.assertEquals(events, [[]])
+
+    def test_860_Backends(self):
+        server = hgapi.CommandServerBackend()
+        repo = hgapi.Repo("./test", backend=server)
+        try:
+            self.assertEquals(repo.hg_log(), self.repo.hg_log())
+            self.assertEquals(list(repo.hg_command_iter("status")),
+                              list(self.repo.hg_command_iter("status")))
+            self.assertEquals(repo[0:2], self.repo[0:2])
+            with self.assertRaises(hgapi.HgException) as context:
+                repo.hg_log(identifier="no-such-revision")
+            self.assertEquals(context.exception.exit_code, 255)
+        finally:
+            server.close()
+        fixtures = tempfile.mkdtemp()
+        try:
+            recorder = hgapi.Repo("./test",
+                                  backend=hgapi.RecordingBackend(fixtures))
+            revisions = recorder.revisions(slice(0, 3))
+            status = recorder.hg_status()
+            matches = list(recorder.hg_grep("watched", revset="all()"))
+            self.assertRaises(hgapi.HgException, recorder.hg_log,
+                              identifier="no-such-revision")
+            replay = hgapi.Repo("./test",
+                                backend=hgapi.ReplayBackend(fixtures))
+            self.assertEquals(replay.revisions(slice(0, 3)), revisions)
+            # repeated commands get the last recording again
+            self.assertEquals(replay.revisions(slice(0, 3)), revisions)
+            self.assertEquals(replay.hg_status(), status)
+            self.assertEquals(list(replay.hg_grep("watched",
+                                                  revset="all()")), matches)
+            with self.assertRaises(hgapi.HgException) as context:
+                replay.hg_log(identifier="no-such-revision")
+            self.assertEquals(context.exception.exit_code, 255)
+            self.assertRaises(hgapi.HgException, replay.hg_heads)
+        finally:
+            shutil.rmtree(fixtures)
+
+    def test_870_Capabilities(self):
+        directory = tempfile.mkdtemp()
+        cache = os.path.join(directory, "cache", "capabilities.json")
+        saved = hgapi.Repo.capabilities_cache, dict(hgapi.hgapi._capabilities)
+        try:
+            hgapi.Repo.capabilities_cache = cache
+            hgapi.hgapi._capabilities.clear()
+            capabilities = hgapi.Repo.capabilities()
+            self.assertTrue(os.path.exists(cache))
+            self.assertEquals(hgapi.Repo.hg_version(), capabilities.version)
+            self.assertTrue(capabilities.version_info >= (1,))
+            self.assertTrue(capabilities.supports("log", "template"))
+            self.assertFalse(capabilities.supports("log", "no-such-option"))
+            self.assertFalse(capabilities.supports("no-such-command"))
+            self.assertTrue("node" in capabilities.template_keywords)
+            self.assertTrue("short" in capabilities.template_filters)
+            self.assertTrue("none" in capabilities.bundle_compressions)
+            self.assertTrue(hgapi.Repo.capabilities() is capabilities)
+            # a new process reads the cache instead of running hg
+            hgapi.hgapi._capabilities.clear()
+            backend = hgapi.Repo.backend
+            hgapi.Repo.backend = hgapi.ReplayBackend(directory)
+            try:
+                cached = hgapi.Repo.capabilities()
+            finally:
+                hgapi.Repo.backend = backend
+            self.assertEquals(cached.to_dict(), capabilities.to_dict())
+            # probes go through the backend of the repo, failures are
+            # cached and a recent Mercurial assumed
+            probes = []
+
+            class Replay(hgapi.ReplayBackend):
+                def run(self, path, env, *args, **kwargs):
+                    probes.append(args)
+                    return super(Replay, self).run(path, env, *args,
+                                                   **kwargs)
+            replay = hgapi.Repo("./test", executable="no-such-hg",
+                                backend=Replay(directory))
+            self.assertTrue(replay._supports("grep", "all-files"))
+            self.assertTrue(probes)
+            del probes[:]
+            self.assertTrue(replay._supports("grep", "all-files"))
+            self.assertEquals(probes, [])
+            self.assertRaises(hgapi.HgException, hgapi.Repo.capabilities,
+                              "no-such-hg")
+        finally:
+            hgapi.Repo.capabilities_cache = saved[0]
+            hgapi.hgapi._capabilities.clear()
+            hgapi.hgapi._capabilities.update(saved[1])
+            shutil.rmtree(directory)
+
 
 def test_doc():
     # prepare for doctest
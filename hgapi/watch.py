@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    Watch repositories for changes by polling their fingerprint, which
+    costs no hg process while nothing changes.
+"""
+from __future__ import print_function, unicode_literals, with_statement
+
+import threading
+
+from .hgapi import Repo, HgException
+
+
+class RepoWatcher(object):
+    """
+        Notify subscribers when the repository at path changes.
+
+        Every interval seconds, the Repo.fingerprint() of the repository
+        is compared with the previous one. When it differs, each
+        subscriber is called with the Repo and the list of the full nodes
+        of the changesets added since the last notification, which is
+        empty when only bookmarks, phases, the working copy or the
+        configuration changed. hg is only run when the fingerprint
+        changed.
+
+        Example::
+
+          >>> watcher = RepoWatcher("main-repo", interval=2)
+          >>> watcher.subscribe(lambda repo, nodes: print(nodes))
+          >>> watcher.start()
+    """
+
+    def __init__(self, path, interval=1.0, profile=None):
+        self.repo = path if isinstance(path, Repo) \
+            else Repo(path, profile=profile)
+        self.interval = interval
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._fingerprint = self.repo.fingerprint()
+        self._tip = self._tip_rev()
+
+    def _tip_rev(self):
+        return int(self.repo.hg_log(identifier="tip", template="{rev}"))
+
+    def subscribe(self, callback):
+        """Call callback(repo, new_nodes) on each change."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stop calling callback."""
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    def poll(self):
+        """
+            Check for a change once, notifying the subscribers. Returns
+            the list of new nodes, or None if nothing changed.
+        """
+        fingerprint = self.repo.fingerprint()
+        if fingerprint == self._fingerprint:
+            return None
+        self._fingerprint = fingerprint
+        tip = self._tip_rev()
+        new_nodes = []
+        if tip > self._tip:
+            revset = "all() - :%d" % self._tip if self._tip >= 0 \
+                else "all()"
+            new_nodes = self.repo.hg_log(identifier=revset,
+                                         template="{node}\\n").split()
+        self._tip = tip
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback(self.repo, new_nodes)
+        return new_nodes
+
+    def start(self):
+        """Poll from a background thread until stop() is called."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except HgException:
+                # e.g. the repository is being written, retry next time
+                self._fingerprint = None
+
+    def stop(self):
+        """Stop polling, waiting for the background thread to finish."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None